@@ -0,0 +1,79 @@
+'''
+Decode time and peak memory of the default and fast_load decode paths.
+
+Writes a large synthetic JPEG and PNG, then loads each one in a fresh
+process with and without fast_load. Reports the best wall time, the size of
+the decoded pixel buffer and the growth of the peak resident set size.
+
+Usage:
+    python benchmarks/bench_decode.py [width] [height] [subsampling_size]
+'''
+
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+from PIL import Image
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from palettely import palette_generator
+
+def make_images(tmp, w, h):
+    rng = np.random.default_rng(0)
+    x = np.linspace(0, 255, w, dtype=np.float32)[None, :, None]
+    y = np.linspace(0, 255, h, dtype=np.float32)[:, None, None]
+    a = np.concatenate(np.broadcast_arrays(x, y, 255-x), axis=2)
+    a += rng.normal(0, 16, (h, 1, 3)).astype(np.float32)
+    im = Image.fromarray(np.clip(a, 0, 255).astype(np.uint8))
+    paths = [os.path.join(tmp, "big.jpg"), os.path.join(tmp, "big.png")]
+    im.save(paths[0], quality=90)
+    im.save(paths[1], compress_level=1)
+    return paths
+
+def child(path, fast, size, repeats=3):
+    p = palette_generator(subsampling_size=size, fast_load=fast)
+    before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    best = float("inf")
+    for _ in range(repeats):
+        t = time.perf_counter()
+        p.load_image(path)
+        best = min(best, time.perf_counter()-t)
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss-before
+    im = Image.open(path)
+    if fast:
+        im.draft("RGB", (size, size))
+    print(json.dumps({"time": best, "peak_kb": peak, "decoded": im.size[0]*im.size[1]*3}))
+
+def run(*args):
+    # every step runs in its own process: the peak RSS survives exec, so the
+    # parent has to stay small for the children's numbers to mean anything
+    out = subprocess.run([sys.executable, __file__]+[str(a) for a in args],
+                         check=True, capture_output=True, text=True).stdout
+    return json.loads(out)
+
+def main():
+    if sys.argv[1:2]==["--child"]:
+        return child(sys.argv[2], bool(int(sys.argv[3])), int(sys.argv[4]))
+    if sys.argv[1:2]==["--make"]:
+        return print(json.dumps(make_images(sys.argv[2], int(sys.argv[3]), int(sys.argv[4]))))
+    w = int(sys.argv[1]) if len(sys.argv)>1 else 6000
+    h = int(sys.argv[2]) if len(sys.argv)>2 else 4000
+    size = int(sys.argv[3]) if len(sys.argv)>3 else 24
+    with tempfile.TemporaryDirectory() as tmp:
+        for path in run("--make", tmp, w, h):
+            full = run("--child", path, 0, size)
+            fast = run("--child", path, 1, size)
+            print(os.path.basename(path))
+            for name, r in (("full", full), ("fast_load", fast)):
+                print("  {:<10} {:>9.1f} ms {:>10.1f} MB decoded {:>10.1f} MB peak".format(
+                    name, r["time"]*1e3, r["decoded"]/2**20, r["peak_kb"]/1024))
+            print("  saved {:.1f}% decode time, {:.1f} MB peak memory".format(
+                100*(1-fast["time"]/full["time"]), (full["peak_kb"]-fast["peak_kb"])/1024))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,119 @@
+'''
+Benchmark of palette_index against linear scans.
+
+Builds an index over synthetic palettes (colors scattered around a random
+base color per image, random area weights) and times radius, nearest and
+similar queries against
+
+    - a vectorized numpy scan over all entries
+    - the plain Python loop over every palette with
+      color.metric.color_distance, measured on a slice of the entries and
+      extrapolated
+
+checking that the index returns the same images as the numpy scan.
+
+    python benchmarks/bench_index.py --images 200000 --colors 10
+'''
+
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from palettely.index import palette_index
+from palettely.color_wheel import color
+
+def make_palettes(n, k, rng):
+    base = rng.integers(0, 256, (n, 1, 3))
+    colors = np.clip(base+rng.normal(0, 40, (n, k, 3)), 0, 255).round().astype(np.uint8)
+    weights = rng.integers(1, 1000, (n, k)).astype(np.float64)
+    return colors, weights/weights.sum(1, keepdims=True)
+
+def best(fn, repeats):
+    t = float("inf")
+    for _ in range(repeats):
+        s = time.perf_counter()
+        ret = fn()
+        t = min(t, time.perf_counter()-s)
+    return t, ret
+
+def scan_radius(colors, weights, target, r, min_weight):
+    d = np.sqrt(((colors.reshape(-1, 3).astype(np.float64)-target)**2).sum(1))
+    hit = (d<=r) & (weights.ravel()>=min_weight)
+    return set(np.flatnonzero(hit)//colors.shape[1])
+
+def scan_nearest(colors, target, k):
+    d = np.sqrt(((colors.astype(np.float64)-target)**2).sum(2)).min(1)
+    return d[np.argsort(d, kind="stable")[:k]]
+
+def scan_similar(index, colors, weights, i, k):
+    n, m = colors.shape[:2]
+    d = index.palette_distance(colors[i].astype(np.float64), weights[i], np.arange(n)*m, np.full(n, m))
+    d[i] = np.inf
+    return np.argsort(d, kind="stable")[:k].tolist()
+
+def python_radius(colors, weights, target, r, min_weight):
+    ret = set()
+    r2 = r*r
+    for i, (pal, w) in enumerate(zip(colors.tolist(), weights.tolist())):
+        for c, cw in zip(pal, w):
+            if cw>=min_weight and color.metric.color_distance(*c, *target)<=r2:
+                ret.add(i)
+                break
+    return ret
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--images", type=int, default=200000, help="number of palettes")
+    parser.add_argument("--colors", type=int, default=10, help="colors per palette")
+    parser.add_argument("--queries", type=int, default=20, help="random query colors")
+    parser.add_argument("--radius", type=float, default=20.0)
+    parser.add_argument("--min-weight", type=float, default=0.1)
+    parser.add_argument("--repeats", type=int, default=3)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    colors, weights = make_palettes(args.images, args.colors, rng)
+    index = palette_index()
+    t = time.perf_counter()
+    for i in range(args.images):
+        index.add(i, list(zip(map(tuple, colors[i].tolist()), weights[i].tolist())))
+    t_add = time.perf_counter()-t
+    t_build, _ = best(index.rebuild, 1)
+    print("{} entries, {} images: add {:.2f} s, grid build {:.1f} ms".format(
+        index.n, len(index), t_add, t_build*1e3))
+
+    targets = rng.integers(0, 256, (args.queries, 3)).astype(np.float64)
+    rows = {"radius": [0.0, 0.0], "nearest k=10": [0.0, 0.0], "similar k=10": [0.0, 0.0]}
+    for target in targets:
+        t_i, hits = best(lambda: index.radius(target, args.radius, args.min_weight), args.repeats)
+        t_s, ref = best(lambda: scan_radius(colors, weights, target, args.radius, args.min_weight), args.repeats)
+        assert set(h[0] for h in hits)==ref
+        rows["radius"][0] += t_i
+        rows["radius"][1] += t_s
+        t_i, hits = best(lambda: index.nearest(target, 10), args.repeats)
+        t_s, ref = best(lambda: scan_nearest(colors, target, 10), args.repeats)
+        assert np.allclose([h[1] for h in hits], ref)
+        rows["nearest k=10"][0] += t_i
+        rows["nearest k=10"][1] += t_s
+    for i in rng.integers(0, args.images, args.queries).tolist():
+        t_i, hits = best(lambda: index.similar(i, 10), args.repeats)
+        t_s, ref = best(lambda: scan_similar(index, colors, weights, i, 10), 1)
+        assert [h[0] for h in hits]==ref
+        rows["similar k=10"][0] += t_i
+        rows["similar k=10"][1] += t_s
+
+    sample = min(args.images, 20000)
+    t_py, _ = best(lambda: python_radius(colors[:sample], weights[:sample], targets[0], args.radius, args.min_weight), 1)
+    t_py *= args.images/sample
+
+    print("\n{:<14} {:>12} {:>16}".format("query", "index (ms)", "numpy scan (ms)"))
+    for name, (t_i, t_s) in rows.items():
+        print("{:<14} {:>12.2f} {:>16.2f}".format(name, t_i/args.queries*1e3, t_s/args.queries*1e3))
+    print("{:<14} {:>12} {:>16.2f}  (Python loop with color_distance, extrapolated)".format("radius", "", t_py*1e3))
+
+if __name__ == "__main__":
+    main()
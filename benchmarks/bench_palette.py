@@ -0,0 +1,237 @@
+'''
+Benchmark suite for palette extraction.
+
+Generates synthetic images (gradients, noise and flat-color blocks) at
+several resolutions and times
+
+    - generate and generate_from_dir end to end
+    - the individual stages: decode, resize, get_mean_cov, push_leaf (the
+      eigen-decompositions), get_max_eigenval_node, partition_node and
+      get_palette
+
+for a sweep of output_colors, subsampling_size and sort modes, recording the
+peak traced memory of every run (peak_bytes), which only covers Python and
+numpy allocations, and the growth of the peak resident set size (peak_rss),
+which includes PIL's decode buffers. peak_rss is measured in a fresh process
+per image and parameter set, as in bench_decode.py, because a warm process
+reuses memory it already holds. Results are written as JSON so that runs of
+different commits can be compared:
+
+    python benchmarks/bench_palette.py -o before.json
+    ... change things ...
+    python benchmarks/bench_palette.py -o after.json --compare before.json
+
+Use --quick for a small sweep.
+'''
+
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+from PIL import Image
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from palettely import palette_generator
+from palettely.stats import _peak_rss, _reset_peak_rss
+
+RESOLUTIONS = [(320, 240), (1280, 960), (4000, 3000)]
+OUTPUT_COLORS = [8, 20, 64]
+SUBSAMPLING_SIZES = [24, 64, 128, 256]
+SORT_MODES = ["area", "value", "eye_catching", "nearest_to"]
+STAGES = ["decode", "resize", "get_mean_cov", "push_leaf", "get_max_eigenval_node", "partition_node", "get_palette"]
+
+def make_gradient(w, h, rng):
+    x = np.linspace(0, 255, w)[None, :, None]
+    y = np.linspace(0, 255, h)[:, None, None]
+    return np.concatenate(np.broadcast_arrays(x, y, 255-x), axis=2).astype(np.uint8)
+
+def make_noise(w, h, rng):
+    return rng.integers(0, 256, (h, w, 3), dtype=np.uint8)
+
+def make_blocks(w, h, rng):
+    cols = rng.integers(0, 256, (64, 3), dtype=np.uint8)
+    grid = rng.integers(0, 64, (8, 8))
+    ys = np.arange(h)*8//h
+    xs = np.arange(w)*8//w
+    return cols[grid[ys[:, None], xs[None, :]]]
+
+KINDS = {"gradient": make_gradient, "noise": make_noise, "blocks": make_blocks}
+
+def make_images(tmp):
+    rng = np.random.default_rng(0)
+    images = []
+    for w, h in RESOLUTIONS:
+        for kind, make in KINDS.items():
+            path = os.path.join(tmp, "{}_{}x{}.jpg".format(kind, w, h))
+            Image.fromarray(make(w, h, rng)).save(path, quality=92)
+            images.append({"kind": kind, "width": w, "height": h, "path": path})
+    return images
+
+class timed_split_tree(palette_generator.split_tree):
+    ''' split_tree that accumulates the time spent in each stage '''
+    timings = None
+
+    def push_leaf(self, node):
+        t = time.perf_counter()
+        try:
+            return super().push_leaf(node)
+        finally:
+            timed_split_tree.timings["push_leaf"] += time.perf_counter()-t
+
+    def get_max_eigenval_node(self):
+        t = time.perf_counter()
+        try:
+            return super().get_max_eigenval_node()
+        finally:
+            timed_split_tree.timings["get_max_eigenval_node"] += time.perf_counter()-t
+
+    def partition_node(self, node):
+        t = time.perf_counter()
+        try:
+            return super().partition_node(node)
+        finally:
+            timed_split_tree.timings["partition_node"] += time.perf_counter()-t
+
+def timed_get_mean_cov(node, _orig=palette_generator.get_mean_cov):
+    t = time.perf_counter()
+    _orig(node)
+    timed_split_tree.timings["get_mean_cov"] += time.perf_counter()-t
+
+def stage_times(p, path, sortby):
+    timings = dict.fromkeys(STAGES, 0.0)
+    timed_split_tree.timings = timings
+    t = time.perf_counter()
+    im = Image.open(path).convert("RGB")
+    timings["decode"] = time.perf_counter()-t
+    t = time.perf_counter()
+    im_ = np.array(im.resize((p.subsampling_size, p.subsampling_size), p.resample), dtype=np.uint8)
+    timings["resize"] = time.perf_counter()-t
+    orig = palette_generator.get_mean_cov
+    palette_generator.get_mean_cov = staticmethod(timed_get_mean_cov)
+    try:
+        tree = timed_split_tree(im_.reshape(-1, 3).astype(np.float64))
+        tree.split(p.no_of_colors-1)
+    finally:
+        palette_generator.get_mean_cov = orig
+    leaves = palette_generator.get_leaf_nodes(tree.root)
+    t = time.perf_counter()
+    palette_generator.get_palette(leaves, sortby, (30, 144, 255))
+    timings["get_palette"] = time.perf_counter()-t
+    return timings
+
+def measure(fn, repeats):
+    best = float("inf")
+    for _ in range(repeats):
+        t = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter()-t)
+    tracemalloc.start()
+    fn()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return best, peak
+
+def rss_child(target, colors, size):
+    p = palette_generator(colors, size)
+    p.generate(np.zeros((8, 8, 3), dtype=np.uint8))
+    # on Linux the high-water mark is reset to the current RSS, elsewhere
+    # the imports may already have set it higher
+    _reset_peak_rss()
+    before = _peak_rss()
+    if os.path.isdir(target):
+        p.generate_from_dir(target)
+    else:
+        p.generate(target)
+    print(max(0, _peak_rss()-before))
+
+def peak_rss(target, colors, size):
+    # ru_maxrss, the fallback off Linux, survives exec, so the child is
+    # started from this small process
+    out = subprocess.run([sys.executable, __file__, "--rss-child", target, str(colors), str(size)],
+                         check=True, capture_output=True, text=True).stdout
+    return int(out)
+
+def git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True,
+                              text=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        return None
+
+def run(args):
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        images = make_images(tmp)
+        for colors in OUTPUT_COLORS:
+            for size in SUBSAMPLING_SIZES:
+                p = palette_generator(colors, size)
+                for img in images:
+                    # the sort order does not change what is allocated
+                    rss = peak_rss(img["path"], colors, size)
+                    for sortby in SORT_MODES:
+                        option = (30, 144, 255) if sortby=="nearest_to" else None
+                        t, peak = measure(lambda: p.generate(img["path"], sortby, option), args.repeats)
+                        stages = stage_times(p, img["path"], sortby)
+                        results.append({"bench": "generate", "image": img["kind"], "width": img["width"],
+                                        "height": img["height"], "output_colors": colors,
+                                        "subsampling_size": size, "sortby": sortby, "time": t,
+                                        "peak_bytes": peak, "peak_rss": rss, "stages": stages})
+                        print("generate {:>8} {:>9} colors={:<3} size={:<4} {:<13} {:>9.2f} ms".format(
+                            img["kind"], "{}x{}".format(img["width"], img["height"]), colors, size, sortby, t*1e3))
+                t, peak = measure(lambda: p.generate_from_dir(tmp), 1)
+                results.append({"bench": "generate_from_dir", "images": len(images), "output_colors": colors,
+                                "subsampling_size": size, "sortby": "area", "time": t, "peak_bytes": peak,
+                                "peak_rss": peak_rss(tmp, colors, size)})
+                print("generate_from_dir {} images colors={:<3} size={:<4} {:>9.2f} ms".format(
+                    len(images), colors, size, t*1e3))
+    return {"revision": git_revision(), "python": platform.python_version(),
+            "numpy": np.__version__, "machine": platform.machine(), "results": results}
+
+def key(r):
+    return (r["bench"], r.get("image"), r.get("width"), r.get("height"), r["output_colors"],
+            r["subsampling_size"], r["sortby"])
+
+def compare(new, old):
+    old = {key(r): r for r in old["results"]}
+    print("\n{:<64} {:>10} {:>10} {:>8} {:>12} {:>12}".format(
+        "benchmark", "old (ms)", "new (ms)", "ratio", "old RSS (MB)", "new RSS (MB)"))
+    for r in new["results"]:
+        o = old.get(key(r))
+        if o is None:
+            continue
+        name = " ".join(str(k) for k in key(r) if k is not None)
+        mb = lambda r: "-" if r.get("peak_rss") is None else "{:.1f}".format(r["peak_rss"]/2**20)
+        print("{:<64} {:>10.2f} {:>10.2f} {:>8.2f} {:>12} {:>12}".format(
+            name, o["time"]*1e3, r["time"]*1e3, r["time"]/o["time"], mb(o), mb(r)))
+
+def main():
+    global RESOLUTIONS, OUTPUT_COLORS, SUBSAMPLING_SIZES, SORT_MODES
+    if sys.argv[1:2]==["--rss-child"]:
+        return rss_child(sys.argv[2], int(sys.argv[3]), int(sys.argv[4]))
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("-o", "--output", default="bench_palette.json", help="where to write the results")
+    parser.add_argument("--compare", help="earlier results to compare against")
+    parser.add_argument("--repeats", type=int, default=3, help="timed repetitions, the best is kept")
+    parser.add_argument("--quick", action="store_true", help="small sweep")
+    args = parser.parse_args()
+    if args.quick:
+        RESOLUTIONS = RESOLUTIONS[:2]
+        OUTPUT_COLORS = OUTPUT_COLORS[:2]
+        SUBSAMPLING_SIZES = SUBSAMPLING_SIZES[:2]
+        SORT_MODES = SORT_MODES[:2]
+    res = run(args)
+    with open(args.output, "w") as f:
+        json.dump(res, f, indent=1)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(res, json.load(f))
+
+if __name__ == "__main__":
+    main()
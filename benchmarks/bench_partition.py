@@ -0,0 +1,50 @@
+'''
+Throughput of the partition engine for growing subsampling sizes.
+
+Runs palette_generator.generate on a synthetic noise + gradient image and
+reports the wall time and the number of subsampled pixels processed per
+second for every subsampling size.
+
+Usage:
+    python benchmarks/bench_partition.py [output_colors] [repeats]
+'''
+
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+from PIL import Image
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from palettely import palette_generator
+
+SIZES = [24, 48, 64, 128, 256]
+
+def make_image(path, w=640, h=480, seed=0):
+    rng = np.random.default_rng(seed)
+    x = np.linspace(0, 255, w)[None, :, None]
+    y = np.linspace(0, 255, h)[:, None, None]
+    base = np.concatenate(np.broadcast_arrays(x, y, 255-x), axis=2)
+    noise = rng.normal(0, 24, (h, w, 3))
+    Image.fromarray(np.clip(base+noise, 0, 255).astype(np.uint8)).save(path)
+
+def main():
+    output_colors = int(sys.argv[1]) if len(sys.argv)>1 else 20
+    repeats = int(sys.argv[2]) if len(sys.argv)>2 else 3
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "bench.png")
+        make_image(path)
+        print("{:>6} {:>10} {:>14}".format("size", "time (ms)", "pixels/s"))
+        for size in SIZES:
+            p = palette_generator(output_colors, size)
+            best = float("inf")
+            for _ in range(repeats):
+                t = time.perf_counter()
+                p.generate(path)
+                best = min(best, time.perf_counter()-t)
+            print("{:>6} {:>10.2f} {:>14.0f}".format(size, best*1e3, size*size/best))
+
+if __name__ == "__main__":
+    main()
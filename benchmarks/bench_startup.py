@@ -0,0 +1,79 @@
+'''
+Startup cost of the palettely package.
+
+Every scenario runs in a fresh interpreter, is repeated and the best wall time
+is kept. Python's own startup (python -c pass) is measured too and subtracted,
+so the numbers are what importing and using palettely adds. The scenarios
+that should stay light (importing the package, harmony math, terminal colors)
+are also checked not to pull in numpy or PIL; the exit status is non zero if
+one does, or if it is slower than --max-ms.
+
+    python benchmarks/bench_startup.py
+    python benchmarks/bench_startup.py --repeats 20 --max-ms 30
+'''
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+HEAVY = ["numpy", "PIL"]
+
+# name, code, whether it must stay free of HEAVY modules
+SCENARIOS = [
+    ("import palettely", "import palettely", True),
+    ("color_wheel harmonies",
+     "from palettely import color_wheel\n"
+     "color_wheel.color_wheel.triadic(30,144,255)\n"
+     "color_wheel.color_wheel.split_complementary(30,144,255,4,30)\n"
+     "color_wheel.color.to_hex(30,144,255)\n"
+     "color_wheel.color.metric.color_distance(30,144,255,0,0,0)", True),
+    ("termcolor", "from palettely import termcolor\ntermcolor.termcolor.rgb('x',(30,144,255))", True),
+    ("palette_generator", "from palettely import palette_generator", False),
+]
+
+REPORT = "\nimport sys, json\nprint(json.dumps([m for m in {} if m in sys.modules]))".format(HEAVY)
+
+def run_once(code):
+    t = time.perf_counter()
+    out = subprocess.run([sys.executable, "-c", code], cwd=ROOT, capture_output=True, text=True, check=True)
+    return time.perf_counter()-t, out.stdout
+
+def best_of(code, repeats):
+    best, out = float("inf"), ""
+    for _ in range(repeats):
+        t, out = run_once(code)
+        best = min(best, t)
+    return best, out
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--repeats", type=int, default=10, help="runs per scenario, the best is kept")
+    parser.add_argument("--max-ms", type=float, default=None,
+                        help="fail if a light scenario adds more than this over bare python")
+    args = parser.parse_args()
+
+    base, _ = best_of("pass", args.repeats)
+    print("{:<24} {:>9.1f} ms".format("python -c pass", base*1e3))
+    failed = False
+    for name, code, light in SCENARIOS:
+        t, out = best_of(code+REPORT, args.repeats)
+        loaded = json.loads(out.strip().splitlines()[-1])
+        extra = (t-base)*1e3
+        note = ""
+        if light and loaded:
+            note = "  FAIL: loads " + ", ".join(loaded)
+            failed = True
+        elif light and args.max_ms is not None and extra>args.max_ms:
+            note = "  FAIL: over {} ms".format(args.max_ms)
+            failed = True
+        elif loaded:
+            note = "  (loads " + ", ".join(loaded) + ")"
+        print("{:<24} {:>9.1f} ms  +{:.1f} ms{}".format(name, t*1e3, extra, note))
+    sys.exit(1 if failed else 0)
+
+if __name__ == "__main__":
+    main()
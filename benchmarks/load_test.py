@@ -0,0 +1,149 @@
+'''
+Load test of the palette service (palettely/service.py).
+
+Starts `python -m palettely.service` on a free local port (or uses --url),
+then keeps --concurrency clients busy, each on its own keep-alive
+connection, POSTing synthetic JPEGs for --duration seconds. Reports
+throughput, latency percentiles, the status codes seen and the mean
+micro-batch size from the server's /stats.
+
+    python benchmarks/load_test.py --concurrency 1 8 64
+    python benchmarks/load_test.py --batch-window 0 --max-batch 1   # no batching
+    python benchmarks/load_test.py --url http://127.0.0.1:8080 --concurrency 32
+
+Server options (--workers, --max-batch, --batch-window, --max-pending,
+--timeout, --processes) are passed on when the server is started here.
+'''
+
+import argparse
+import asyncio
+import collections
+import io
+import json
+import os
+import subprocess
+import sys
+import time
+import urllib.parse
+
+import numpy as np
+from PIL import Image
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+def make_images(n, width, height):
+    rng = np.random.default_rng(0)
+    images = []
+    for i in range(n):
+        x = np.linspace(0, 255, width)[None, :, None]
+        y = np.linspace(0, 255, height)[:, None, None]
+        im = np.concatenate(np.broadcast_arrays(x, y, 255-x), axis=2)
+        im = np.clip(im+rng.normal(0, 20, im.shape)+rng.integers(-60, 60, 3), 0, 255).astype(np.uint8)
+        buf = io.BytesIO()
+        Image.fromarray(im).save(buf, "JPEG", quality=90)
+        images.append(buf.getvalue())
+    return images
+
+async def request(reader, writer, host, method, path, body=b""):
+    writer.write("{} {} HTTP/1.1\r\nHost: {}\r\nContent-Length: {}\r\n\r\n".format(
+        method, path, host, len(body)).encode()+body)
+    await writer.drain()
+    status = int((await reader.readline()).split()[1])
+    length = 0
+    while True:
+        h = await reader.readline()
+        if h in (b"\r\n", b""):
+            break
+        k, _, v = h.decode().partition(":")
+        if k.lower()=="content-length":
+            length = int(v)
+    return status, await reader.readexactly(length)
+
+async def client(host, port, path, images, deadline, latencies, statuses, offset):
+    reader, writer = await asyncio.open_connection(host, port)
+    i = offset
+    try:
+        while time.perf_counter()<deadline:
+            t = time.perf_counter()
+            status, _ = await request(reader, writer, host, "POST", path, images[i%len(images)])
+            latencies.append(time.perf_counter()-t)
+            statuses[status] += 1
+            i += 1
+    finally:
+        writer.close()
+
+async def get_stats(host, port):
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        return json.loads((await request(reader, writer, host, "GET", "/stats"))[1])
+    finally:
+        writer.close()
+
+async def run_level(host, port, path, images, concurrency, duration):
+    before = await get_stats(host, port)
+    latencies = []
+    statuses = collections.Counter()
+    t = time.perf_counter()
+    await asyncio.gather(*(client(host, port, path, images, t+duration, latencies, statuses, k)
+                           for k in range(concurrency)))
+    elapsed = time.perf_counter()-t
+    after = await get_stats(host, port)
+    batches = after["batches"]-before["batches"]
+    lat = np.array(latencies)*1e3
+    return {"concurrency": concurrency, "requests": len(latencies), "throughput": len(latencies)/elapsed,
+            "p50": np.percentile(lat, 50), "p90": np.percentile(lat, 90), "p99": np.percentile(lat, 99),
+            "max": lat.max(), "statuses": dict(statuses),
+            "mean_batch": (after["batched"]-before["batched"])/batches if batches else 0.0}
+
+def start_server(args):
+    cmd = [sys.executable, "-m", "palettely.service", "--port", "0"]
+    for opt in ("workers", "max_batch", "batch_window", "max_pending", "timeout"):
+        if getattr(args, opt) is not None:
+            cmd += ["--"+opt.replace("_", "-"), str(getattr(args, opt))]
+    if args.processes:
+        cmd.append("--processes")
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [ROOT, os.environ.get("PYTHONPATH")])))
+    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, text=True, env=env)
+    line = proc.stdout.readline()
+    if not line.startswith("listening on"):
+        proc.kill()
+        sys.exit("server did not start")
+    return proc, line.split()[-1]
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", help="use a running server instead of starting one")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 8, 32], help="client counts to run")
+    parser.add_argument("--duration", type=float, default=5.0, help="seconds per concurrency level")
+    parser.add_argument("--images", type=int, default=16, help="distinct images to cycle through")
+    parser.add_argument("--size", type=int, nargs=2, default=[640, 480], metavar=("W", "H"), help="image size")
+    parser.add_argument("--query", default="top=8", help="query string of the requests")
+    parser.add_argument("--workers", type=int)
+    parser.add_argument("--max-batch", type=int)
+    parser.add_argument("--batch-window", type=float)
+    parser.add_argument("--max-pending", type=int)
+    parser.add_argument("--timeout", type=float)
+    parser.add_argument("--processes", action="store_true")
+    args = parser.parse_args()
+
+    images = make_images(args.images, *args.size)
+    proc = None
+    url = args.url
+    if url is None:
+        proc, url = start_server(args)
+    u = urllib.parse.urlsplit(url)
+    path = "/palette?"+args.query
+    try:
+        print("{:>11} {:>9} {:>10} {:>8} {:>8} {:>8} {:>8} {:>10}  statuses".format(
+            "concurrency", "requests", "req/s", "p50 ms", "p90 ms", "p99 ms", "max ms", "mean batch"))
+        for c in args.concurrency:
+            r = asyncio.run(run_level(u.hostname, u.port, path, images, c, args.duration))
+            print("{concurrency:>11} {requests:>9} {throughput:>10.1f} {p50:>8.1f} {p90:>8.1f} {p99:>8.1f} "
+                  "{max:>8.1f} {mean_batch:>10.1f}  {statuses}".format(**r))
+    finally:
+        if proc is not None:
+            proc.terminate()
+            proc.wait()
+
+if __name__ == "__main__":
+    main()
@@ -10,12 +10,39 @@ _|          _|_|_|  _|    _|_|_|      _|_|    _|_|    _|_|_|  _|    _|_|_|
 
 '''
 
-from . import termcolor
-from . import color_wheel
-from .__main__ import palette_generator
+import importlib
+
+# submodules and classes are only imported on first access, so that e.g.
+# color_wheel can be used without paying for numpy and PIL
+_lazy = {
+"termcolor":(".termcolor",None),
+"color_wheel":(".color_wheel",None),
+"palette_generator":(".__main__","palette_generator"),
+"palette_cache":(".cache","palette_cache"),
+"palette_stats":(".stats","palette_stats"),
+"palette_service":(".service","palette_service"),
+"palette_index":(".index","palette_index"),
+}
 
 __all__ = [
 "termcolor",
 "color_wheel",
-"palette_generator"
-]
\ No newline at end of file
+"palette_generator",
+"palette_cache",
+"palette_stats",
+"palette_service",
+"palette_index"
+]
+
+def __getattr__(name):
+    if name not in _lazy:
+        raise AttributeError("module {!r} has no attribute {!r}".format(__name__,name))
+    module, attr = _lazy[name]
+    value = importlib.import_module(module,__name__)
+    if attr!=None:
+        value = getattr(value,attr)
+    globals()[name] = value
+    return value
+
+def __dir__():
+    return sorted(set(globals())|set(__all__))
@@ -12,12 +12,24 @@ _|          _|_|_|  _|    _|_|_|      _|_|    _|_|    _|_|_|  _|    _|_|_|
 
 import numpy as np
 from PIL import Image
+from PIL import ImageSequence
 import colorsys
+import heapq
 from collections import deque
-from .termcolor import termcolor
+from .termcolor import palette_renderer
 from .color_wheel import color_wheel
 from .color_wheel import color
+from .stats import palette_stats
 import os
+import time
+import contextlib
+import io
+import fnmatch
+import itertools
+import concurrent.futures
+import argparse
+import json
+import sys
 
 class palette_generator:
     ''' Palette Generator Class
@@ -44,100 +56,431 @@ class palette_generator:
                                                                 # colors first
     # Generate palette for all image files in the home directory
     p.generate_from_dir("~",top=20,sortby="eye_catching",verbose=True)
+    # Same, spread over 4 worker processes
+    p.generate_from_dir("~",top=20,sortby="eye_catching",jobs=4)
+    # Largest colors first with their pixel counts, ignoring colors covering
+    # less than 1% of the image
+    p.generate(file,sortby="area",min_coverage=0.01,counts=True)
+    # Per-frame palettes of an animated GIF and the palette of all frames
+    frames, overall = p.generate_frames("~/anim.gif",top=8)
+    # Best palette available within 20 ms, coarse ones shown as they come
+    for palette, progress in p.iter_progressive(file,top=8,deadline=0.02):
+        show(palette)
+    # Posterize the full resolution image to its own 45 colors
+    indices, counts, tree = p.quantize(file)
+    Image.fromarray(tree.colors()[indices]).save("poster.png")
+
+    From the shell, one JSON line per image:
+    python -m palettely ~/photos -n 45 -t 20 --jobs 4 > palettes.jsonl
+    find ~ -name '*.png' | python -m palettely --sortby eye_catching
     '''
-    classes = None
-    im = None
-    im_ = None
-    tree_root = None
+    # bump whenever a change to the clustering changes its output, cached
+    # palettes of older versions are then ignored
+    algorithm_version = 1
 
-    def __init__(self,output_colors=20,subsampling_size=24):
+    def __init__(self,output_colors=20,subsampling_size=24,fast_load=False,resample=Image.BICUBIC,cache=None,histogram=False):
         self.no_of_colors = output_colors
         self.subsampling_size = subsampling_size
+        # decode close to the subsampling size instead of at full resolution
+        self.fast_load = fast_load
+        self.resample = resample
+        # optional palette_cache
+        self.cache = cache
+        # cluster the unique colors weighted by their pixel counts, much
+        # cheaper for flat-color artwork and gives the same leaves
+        self.histogram = histogram
 
     class tree_node:
-        def __init__(self,classid):
+        def __init__(self,classid,indices=None):
             self.classid = classid
             self.right = None
             self.left = None
+            # pixels of this class and their sufficient statistics
+            self.indices = indices
+            self.count = 0
+            self.sum = None
+            self.sxx = None
             self.cov = None
             self.mean = None
+            self.eigval = 0.0
+            self.eigvec = None
+            self.threshold = None
 
-    @staticmethod
-    def straighten(img):
-        return np.ma.resize(img,(img.shape[0]*img.shape[1],3)).T
+    class split_tree:
+        ''' Working state of one clustering run
 
-    @staticmethod
-    def get_max_eigenval_node(tree_node):
-        max_eigen = -1
-        ret = None
-        # if only one node in tree
-        if tree_node.left==None and tree_node.right==None:
-            return tree_node
-        q = deque()
-        q.append(tree_node)
-        while (q):
-            a = q.popleft()
-            if (a.right!=None and a.left!=None):
-                q.append(a.left)
-                q.append(a.right)
-                continue
-            eigv = np.linalg.eigvals(a.cov)
-            if (eigv[0]>max_eigen):
-                max_eigen = eigv[0]
-                ret = a
-        return ret
+        Holds the subsampled pixels, their class labels, the split tree and the
+        heap of splittable leaves. Every call to generate builds its own
+        instance, so a palette_generator can be used from several threads or
+        processes at once.
+        '''
+        # leaves whose variance along the principal axis is below this are
+        # considered flat and are never split
+        min_eigenval = 1e-8
 
-    @staticmethod
-    def partition_node(node, nextid, img_shape):
-        m = node.mean
-        c = node.cov
-        leftid = nextid
-        rightid = nextid+1
-        eigvals, eigvecs = np.linalg.eig(np.array(c))
-        eigvecs = eigvecs[0]
-        threshold = np.dot(eigvecs,m.T)
-
-        node.left = palette_generator.tree_node(leftid)
-        node.right = palette_generator.tree_node(rightid)
-
-        for a in range(img_shape[0]):
-            for b in range(img_shape[1]):
-                if (palette_generator.classes[a,b]!=node.classid)[0]:
+        def __init__(self,pixels,weights=None,stats=None):
+            self.pixels = pixels
+            # optional per-pixel weights (pixel counts in histogram mode)
+            self.weights = weights
+            # optional palette_stats collecting per-split numbers
+            self.stats = stats
+            self.labels = np.ones(pixels.shape[0],dtype=np.int32)
+            self.root = palette_generator.tree_node(1,np.arange(pixels.shape[0]))
+            self.leaf_heap = []
+            self.next_id = 2
+            self.accumulate(self.root)
+            palette_generator.get_mean_cov(self.root)
+            self.push_leaf(self.root)
+
+        def accumulate(self,node):
+            px = self.pixels[node.indices]
+            if self.weights is None:
+                node.count = px.shape[0]
+                node.sum = px.sum(0)
+                node.sxx = px.T.dot(px)
+            else:
+                w = self.weights[node.indices]
+                node.count = w.sum()
+                node.sum = w.dot(px)
+                node.sxx = (px.T*w).dot(px)
+
+        def push_leaf(self,node):
+            # eigen-decomposition is done once per node, the heap is keyed on
+            # the largest eigenvalue (eigh returns them in ascending order)
+            node.eigval = 0.0
+            node.eigvec = None
+            if node.count>1:
+                eigvals, eigvecs = np.linalg.eigh(node.cov)
+                node.eigval = eigvals[-1]
+                node.eigvec = eigvecs[:,-1]
+            if node.eigval>self.min_eigenval:
+                heapq.heappush(self.leaf_heap,(-node.eigval,node.classid,node))
+
+        def get_max_eigenval_node(self):
+            if not self.leaf_heap:
+                return None
+            return heapq.heappop(self.leaf_heap)[2]
+
+        def partition_node(self,node):
+            leftid = self.next_id
+            rightid = self.next_id+1
+            threshold = np.dot(node.eigvec,node.mean)
+
+            # project all pixels of the class onto the eigenvector in one go
+            # and relabel them with a mask
+            members = node.indices
+            go_left = self.pixels[members].dot(node.eigvec)<=threshold
+            n_left = np.count_nonzero(go_left)
+            if n_left==0 or n_left==members.shape[0]:
+                # numerically flat class, nothing to split
+                return False
+            self.labels[members] = np.where(go_left,leftid,rightid)
+            self.next_id += 2
+            node.threshold = threshold
+
+            node.left = palette_generator.tree_node(leftid,members[go_left])
+            node.right = palette_generator.tree_node(rightid,members[~go_left])
+            node.indices = None
+
+            # only the left child is summed, the right one is what remains of
+            # the parent
+            self.accumulate(node.left)
+            node.right.count = node.count-node.left.count
+            node.right.sum = node.sum-node.left.sum
+            node.right.sxx = node.sxx-node.left.sxx
+            return True
+
+        def split(self,n):
+            ''' Split the highest variance leaves until n splits have been made
+                or no leaf is left to split
+            '''
+            splits = 0
+            while splits<n:
+                # get max eigenvalue node
+                m = self.get_max_eigenval_node()
+                if m==None:
+                    break
+                if self.stats is not None:
+                    t = time.perf_counter()
+                    pixels = m.indices.shape[0]
+                # partition class
+                if not self.partition_node(m):
                     continue
-                val = np.dot(eigvecs,palette_generator.im_[a,b].T)
-                if (val<=threshold):
-                    palette_generator.classes[a,b] = [leftid]*3
+                splits += 1
+                # get mean cov of left and right
+                palette_generator.get_mean_cov(m.left)
+                palette_generator.get_mean_cov(m.right)
+                self.push_leaf(m.left)
+                self.push_leaf(m.right)
+                if self.stats is not None:
+                    self.stats.record_split(time.perf_counter()-t,pixels)
+            return splits
+
+    class palette_tree:
+        ''' Compact array form of a finished split tree
+
+        Nodes are numbered breadth first from the root (0) and stored as
+        arrays: eigvec (M,3) and threshold (M,) of every split, left and
+        right (M,) children (-1 at leaves), mean (M,3) and count (M,) of
+        every node, and leaf (M,), the palette index of each leaf (-1 for
+        inner nodes). Palette indices follow get_leaf_nodes, so index i is
+        the i-th of leaves().
+
+        A pixel goes left when its projection on eigvec is <= threshold,
+        the same test split_tree used, so assign reproduces the clustering
+        exactly and extends it to any other pixels, e.g. the full resolution
+        image (remap) or the next frame of an animation (replay).
+        '''
+        def __init__(self,tree):
+            nodes = []
+            q = deque([tree.root])
+            while q:
+                a = q.popleft()
+                nodes.append(a)
+                if a.left!=None:
+                    q.append(a.left)
+                    q.append(a.right)
+            M = len(nodes)
+            number = {id(a):i for i, a in enumerate(nodes)}
+            self.classid = np.array([a.classid for a in nodes],dtype=np.int32)
+            self.eigvec = np.zeros((M,3))
+            self.threshold = np.zeros(M)
+            self.left = np.full(M,-1,dtype=np.int32)
+            self.right = np.full(M,-1,dtype=np.int32)
+            self.mean = np.array([a.mean for a in nodes],dtype=np.float64).reshape(M,3)
+            self.count = np.array([a.count for a in nodes],dtype=np.float64)
+            self.leaf = np.full(M,-1,dtype=np.int32)
+            k = 0
+            for i, a in enumerate(nodes):
+                if a.left==None:
+                    self.leaf[i] = k
+                    k += 1
                 else:
-                    palette_generator.classes[a,b] = [rightid]*3
+                    self.eigvec[i] = a.eigvec
+                    self.threshold[i] = a.threshold
+                    self.left[i] = number[id(a.left)]
+                    self.right[i] = number[id(a.right)]
+            self.leaf_nodes = np.flatnonzero(self.leaf>=0)
+            # counts of unweighted trees are pixel counts
+            self.integral = tree.weights is None
+
+        def __len__(self):
+            ''' Number of palette colors '''
+            return self.leaf_nodes.shape[0]
 
-        return
+        def leaves(self):
+            ''' Returns the leaves as (classid, mean, count) tuples, as
+                get_leaf_nodes does
+            '''
+            n = self.leaf_nodes
+            count = self.count[n].astype(np.int64) if self.integral else self.count[n]
+            return [(i,m,c) for i, m, c in zip(self.classid[n].tolist(),self.mean[n].copy(),count.tolist())]
+
+        def colors(self):
+            ''' (K,3) uint8 palette colors, by palette index, truncated like
+                get_palette
+            '''
+            return np.clip(self.mean[self.leaf_nodes],0,255).astype(np.uint8)
+
+        def assign(self,pixels):
+            ''' Palette index of every pixel
+
+            Arguments:
+                pixels {numpy.ndarray} -- float64 array (N,3)
+
+            Returns:
+                numpy.ndarray -- int32 array (N,)
+            '''
+            ret = np.empty(pixels.shape[0],dtype=np.int32)
+            stack = [(0,np.arange(pixels.shape[0]))]
+            while stack:
+                i, members = stack.pop()
+                if self.left[i]<0:
+                    ret[members] = self.leaf[i]
+                    continue
+                go_left = pixels[members].dot(self.eigvec[i])<=self.threshold[i]
+                stack.append((self.left[i],members[go_left]))
+                stack.append((self.right[i],members[~go_left]))
+            return ret
+
+        def replay(self,pixels,weights=None):
+            ''' Cluster other pixels with this tree
+
+            Returns:
+                tuple -- leaves as (classid, mean, count) tuples, as leaves()
+                         does, and the drift: the pixel weighted mean distance
+                         of the leaf means from those the tree was built on,
+                         inf if a leaf came out empty
+            '''
+            K = len(self)
+            idx = self.assign(pixels)
+            count = np.bincount(idx,weights,minlength=K)
+            w = pixels if weights is None else pixels*weights[:,None]
+            sums = np.stack([np.bincount(idx,w[:,c],minlength=K) for c in range(3)],1)
+            if not count.all():
+                drift = np.inf
+                mean = sums/np.maximum(count,1)[:,None]
+            else:
+                mean = sums/count[:,None]
+                old = self.mean[self.leaf_nodes]
+                drift = float(np.dot(count,np.linalg.norm(mean-old,axis=1))/count.sum())
+            if weights is None:
+                count = count.astype(np.int64)
+            return [(i,m,c) for i, m, c in zip(self.classid[self.leaf_nodes].tolist(),mean,count.tolist())], drift
+
+        def remap(self,image,out=None,colors=False,max_memory=64<<20):
+            ''' Map every pixel of an image, of any size, to the palette
+
+            The image is processed in chunks of rows sized so that the
+            temporary arrays stay within about max_memory bytes, whatever the
+            resolution. With a numpy.memmap as image (see
+            palette_generator.quantize_raw) only one chunk is read from disk
+            at a time, and out can be a memmap as well.
+
+            Arguments:
+                image {numpy.ndarray|PIL.Image} -- the image; arrays other
+                                                   than (H,W,3) uint8, e.g.
+                                                   grayscale or RGBA, are
+                                                   converted to RGB chunk by
+                                                   chunk as in generate
+
+            Keyword Arguments:
+                out {numpy.ndarray} -- where to write the result, allocated if
+                                       None (default: {None})
+                colors {bool} -- write (H,W,3) palette colors instead of (H,W)
+                                 palette indices (default: {False})
+                max_memory {int} -- working set of a chunk in bytes
+                                    (default: {64 MiB})
+
+            Returns:
+                tuple -- out, and the exact pixel count of every palette color
+                         as an int64 array (K,)
+            '''
+            if isinstance(image,Image.Image):
+                if image.mode!='RGB':
+                    image = image.convert('RGB')
+                W, H = image.size
+            else:
+                H, W = image.shape[:2]
+            K = len(self)
+            if out is None:
+                out = np.empty((H,W,3),dtype=np.uint8) if colors else np.empty((H,W),dtype=np.uint8 if K<=256 else np.uint16)
+            lut = self.colors()
+            counts = np.zeros(K,dtype=np.int64)
+            # float64 pixels, their projections, masks and index arrays come
+            # to roughly 64 bytes per pixel
+            rows = max(1,max_memory//(64*W))
+            for y in range(0,H,rows):
+                if isinstance(image,Image.Image):
+                    chunk = np.asarray(image.crop((0,y,W,min(y+rows,H))))
+                else:
+                    chunk = np.asarray(image[y:y+rows])
+                    if chunk.ndim!=3 or chunk.shape[2]!=3 or chunk.dtype!=np.uint8:
+                        chunk = np.asarray(Image.fromarray(np.ascontiguousarray(chunk)).convert('RGB'))
+                h = chunk.shape[0]
+                idx = self.assign(chunk.reshape(-1,3).astype(np.float64))
+                counts += np.bincount(idx,minlength=K)
+                out[y:y+h] = lut[idx].reshape(h,W,3) if colors else idx.reshape(h,W)
+            return out, counts
 
     @staticmethod
-    def get_mean_cov(node):
-        masked_im = np.ma.masked_where((palette_generator.classes!=node.classid),palette_generator.im_)
-        node.mean = np.mean(palette_generator.straighten(masked_im),1)
-        node.cov = np.ma.cov(palette_generator.straighten(masked_im))
+    def split_stacked(pixels,n):
+        ''' Run the eigen-split clustering on a stack of equally sized images
+
+        All images advance together: every iteration splits the highest
+        variance leaf of each image using batched statistics and a batched
+        eigh on (N,2,3,3) stacks, so the per-image Python overhead of
+        split_tree is paid once per iteration instead of once per image.
+
+        Arguments:
+            pixels {numpy.ndarray} -- float array of shape (N,P,3)
+            n {int} -- number of splits per image
+
+        Returns:
+            tuple -- means (N,n+1,3), counts (N,n+1) and leaves (N,) holding
+                     the number of valid leaves of every image
+        '''
+        N, P, _ = pixels.shape
+        M = n+1
+        rows = np.arange(N)
+        labels = np.zeros((N,P),dtype=np.int32)
+        counts = np.zeros((N,M))
+        sums = np.zeros((N,M,3))
+        sxx = np.zeros((N,M,3,3))
+        means = np.zeros((N,M,3))
+        eigval = np.full((N,M),-np.inf)
+        eigvec = np.zeros((N,M,3))
+        leaves = np.ones(N,dtype=np.int64)
+
+        def update(idx,slot):
+            # mean, covariance and principal axis of leaf slot[i] of image idx[i]
+            c = counts[idx,slot]
+            m = sums[idx,slot]/np.maximum(c,1)[:,None]
+            cov = (sxx[idx,slot]-c[:,None,None]*m[:,:,None]*m[:,None,:])/np.maximum(c-1,1)[:,None,None]
+            w, v = np.linalg.eigh(cov)
+            means[idx,slot] = m
+            eigval[idx,slot] = np.where(c>1,w[:,-1],-np.inf)
+            eigvec[idx,slot] = v[:,:,-1]
+
+        # every pixel and its outer product with itself, flattened
+        features = np.concatenate((pixels,(pixels[:,:,:,None]*pixels[:,:,None,:]).reshape(N,P,9)),2)
+        counts[:,0] = P
+        sums[:,0] = pixels.sum(1)
+        sxx[:,0] = features[:,:,3:].sum(1).reshape(N,3,3)
+        update(rows,np.zeros(N,dtype=np.int64))
+
+        while True:
+            j = np.argmax(eigval,1)
+            active = (eigval[rows,j]>palette_generator.split_tree.min_eigenval) & (leaves<M)
+            if not active.any():
+                break
+            # all images are processed together, the inactive ones are masked
+            # out, which is cheaper than gathering the active ones
+            v = eigvec[rows,j]
+            threshold = np.einsum('nc,nc->n',means[rows,j],v)
+            member = (labels==j[:,None]) & active[:,None]
+            go_left = member & (np.matmul(pixels,v[:,:,None])[:,:,0]<=threshold[:,None])
+            n_left = go_left.sum(1)
+
+            # numerically flat leaves are never split again
+            flat = active & ((n_left==0) | (n_left==counts[rows,j]))
+            eigval[rows[flat],j[flat]] = -np.inf
+            ok = active & ~flat
+            go_left &= ok[:,None]
+            go_right = member & ~go_left & ok[:,None]
+            idx, j, new = rows[ok], j[ok], leaves[ok]
+
+            # the left child keeps the parent's slot, the right one is what
+            # remains of the parent. Sum and sum of outer products come out of
+            # a single product with the per-pixel features
+            l_stats = np.matmul(go_left[:,None,:].astype(np.float64),features)[idx,0]
+            l_count = n_left[idx].astype(np.float64)
+            l_sum = l_stats[:,:3]
+            l_sxx = l_stats[:,3:].reshape(-1,3,3)
+            counts[idx,new] = counts[idx,j]-l_count
+            sums[idx,new] = sums[idx,j]-l_sum
+            sxx[idx,new] = sxx[idx,j]-l_sxx
+            counts[idx,j] = l_count
+            sums[idx,j] = l_sum
+            sxx[idx,j] = l_sxx
+            labels = np.where(go_right,leaves[:,None],labels)
+            leaves[idx] += 1
+            update(np.concatenate((idx,idx)),np.concatenate((j,new)))
+
+        return means, counts, leaves
 
     @staticmethod
-    def get_next_id(root_node):
-        q = deque()
-        max_id = 1
-        if root_node.left==None and root_node.right==None:
-            return max_id+1
-        q.append(root_node)
-        while (q):
-            a = q.popleft()
-            if a.classid>max_id:
-                max_id=a.classid
-            if (a.left!=None and a.right!=None):
-                q.append(a.left)
-                q.append(a.right)
-        return max_id+1
+    def get_mean_cov(node):
+        node.mean = node.sum/node.count
+        if node.count>1:
+            node.cov = (node.sxx-node.count*np.outer(node.mean,node.mean))/(node.count-1)
+        else:
+            node.cov = np.zeros((3,3))
 
     @staticmethod
     def get_leaf_nodes(root_node):
         if root_node.left==None and root_node.right==None:
-            return [1]
+            return [(root_node.classid,np.array(root_node.mean),root_node.count)]
         ret = []
         q = deque()
         q.append(root_node)
@@ -145,7 +488,7 @@ class palette_generator:
         while (q):
             a = q.popleft()
             if (a.left==None and a.right==None):
-                ret.append((a.classid,np.array(a.mean)))
+                ret.append((a.classid,np.array(a.mean),a.count))
             else:
                 q.append(a.left)
                 q.append(a.right)
@@ -164,78 +507,942 @@ class palette_generator:
         Image.fromarray((np.append(np.array(im),palette,axis=1))).show()
         
     @staticmethod
-    def get_palette(leaf_nodes,sortby='area',option=None):
-        palette = []
-        for i in leaf_nodes:
-            palette.append(tuple([int(x) for x in i[1]]))
-        if (sortby=='saturation'):
-            palette.sort(key=lambda tup:color.metric.normalized_saturation(*tup))
+    def get_palette(leaf_nodes,sortby='area',option=None,min_coverage=0.0,counts=False):
+        ''' Turn leaves into a sorted palette
+
+        Arguments:
+            leaf_nodes {list} -- (classid, mean, count) tuples
+
+        Keyword Arguments:
+            sortby {str} -- sort order, 'area' puts the most populated colors
+                            first (default: {'area'})
+            option {tuple} -- target color for sortby='nearest_to'
+                              (default: {None})
+            min_coverage {float} -- drop colors covering less than this
+                                    fraction of the pixels (default: {0.0})
+            counts {bool} -- return ((R,G,B), pixel count) tuples instead of
+                             bare colors (default: {False})
+        '''
+        colors = np.array([i[1] for i in leaf_nodes],dtype=np.float64).reshape(-1,3).astype(np.int64)
+        pop = np.array([i[2] for i in leaf_nodes],dtype=np.float64).astype(np.int64)
+        if min_coverage:
+            keep = pop>=min_coverage*pop.sum()
+            colors, pop = colors[keep], pop[keep]
+        # all sort keys are computed in one pass, descending orders are
+        # negated so that a stable argsort keeps ties in leaf order
+        key = None
+        if (sortby=='area'):
+            key = -pop
+        elif (sortby=='saturation'):
+            key = color.metric.normalized_saturation_array(colors)
         elif (sortby=='value'):
-            palette.sort(key=lambda tup:color.metric.normalized_value(*tup), reverse=True)
+            key = -color.metric.normalized_value_array(colors)
         elif (sortby=='saturation+value'):
-            palette.sort(key=lambda tup:1-color.metric.normalized_saturation(*tup)+color.metric.normalized_value(*tup), reverse=True)
+            key = -(1-color.metric.normalized_saturation_array(colors)+color.metric.normalized_value_array(colors))
         elif (sortby=='standard_deviation' or sortby=='distance_from_gray' or sortby=='eye_catching'):
-            palette.sort(key=lambda tup:1-color.metric.standard_deviation(*tup))
+            key = 1-color.metric.standard_deviation_array(colors)
         elif (sortby=='nearest_to'):
-            if type(option)!=tuple and len(option)!=3:
+            if option is None or len(option)!=3:
                 raise Exception("Incorrect syntax for option argument")
-            palette.sort(key=lambda tup:1-color.metric.color_distance(*tup,*option), reverse=True)
+            key = color.metric.color_distance_array(colors,option)
+        if key is not None:
+            order = np.argsort(key,kind='stable')
+            colors, pop = colors[order], pop[order]
+        palette = [tuple(c) for c in colors.tolist()]
+        if counts:
+            return list(zip(palette,pop.tolist()))
         return palette
 
-    def generate(self, img_path, sortby="area", option=None, top=None, verbose=False):
-        if (not os.path.isfile(img_path)):
+    @staticmethod
+    def rank_by_nearest(palettes,targets):
+        ''' Rank many palettes against many target colors at once
+
+        The distance of a palette to a target is the distance of its nearest
+        color, as with sortby='nearest_to'. Everything comes out of a single
+        pairwise distance matrix between the targets and all palette colors.
+
+        Arguments:
+            palettes {list} -- palettes, lists of (R,G,B) tuples
+            targets {list} -- (R,G,B) target colors
+
+        Returns:
+            tuple -- (M,P) array of the distance of every palette to every
+                     target and (M,P) array of palette indices, nearest first
+        '''
+        sizes = np.array([len(p) for p in palettes])
+        targets = np.asarray(targets,dtype=np.float64).reshape(-1,3)
+        dist = np.full((targets.shape[0],len(palettes)),np.inf)
+        if sizes.sum():
+            colors = np.concatenate([np.asarray(p,dtype=np.float64).reshape(-1,3) for p in palettes if len(p)])
+            d = color.metric.pairwise_distance(targets,colors)
+            starts = np.concatenate(([0],np.cumsum(sizes[sizes>0])[:-1]))
+            dist[:,sizes>0] = np.minimum.reduceat(d,starts,axis=1)
+        return dist, np.argsort(dist,axis=1,kind='stable')
+
+    def generate(self, img_path, sortby="area", option=None, top=None, verbose=False, min_coverage=0.0, counts=False, stats=None):
+        ''' Generate the palette of an image
+
+        Besides a filename, the image can be given as a PIL.Image, a uint8
+        numpy array of shape (H,W,3) (or anything else Image.fromarray takes),
+        the encoded file contents as bytes / bytearray / memoryview, or a
+        binary file-like object. Arrays and PIL images are not decoded at all
+        and buffers are decoded straight from memory. See generate_from_raw
+        for memory-mapped raw RGB files.
+
+        Arguments:
+            img_path {str|PIL.Image|numpy.ndarray|bytes|file} -- the image
+
+        Keyword Arguments:
+            sortby {str} -- sort order of the palette (default: {"area"})
+            option {tuple} -- target color for sortby="nearest_to"
+                              (default: {None})
+            top {int} -- only return the first top colors (default: {None})
+            verbose {bool} -- print the palette to the terminal
+                              (default: {False})
+            min_coverage {float} -- drop colors covering less than this
+                                    fraction of the image (default: {0.0})
+            counts {bool} -- return ((R,G,B), pixel count) tuples
+                             (default: {False})
+            stats {palette_stats|bool} -- collect per-stage timings into this
+                                          palette_stats, or a new one if True
+                                          (default: {None})
+
+        Returns:
+            list -- (R,G,B) tuples, or (palette, palette_stats) with stats
+        '''
+        if isinstance(img_path,(str,os.PathLike)) and not os.path.isfile(img_path):
             raise Exception("Image file not found")
             return
-        palette_generator.im = Image.open(img_path).convert('RGB')
-        im_r = palette_generator.im.resize((self.subsampling_size,self.subsampling_size))
-        palette_generator.im_ = np.array(im_r, dtype=np.uint8)
+        if stats is True:
+            stats = palette_stats()
+        timer = palette_generator.no_timer if stats is None else stats.timer
+        with contextlib.nullcontext() if stats is None else stats.image(palette_generator.source_name(img_path)):
+            digest = None
+            leaves = None
+            if self.cache!=None:
+                with timer('cache'):
+                    if isinstance(img_path,(str,os.PathLike)):
+                        digest = self.cache.digest(img_path)
+                    elif isinstance(img_path,(bytes,bytearray,memoryview)):
+                        digest = self.cache.hash_buffer(img_path)
+                    if digest!=None:
+                        leaves = self.cache.get(digest,self.cache_params())
+            if leaves==None:
+                leaves = self.get_leaves(img_path,stats)
+                if digest!=None:
+                    with timer('cache'):
+                        self.cache.put(digest,self.cache_params(),leaves)
 
-        palette_generator.tree_root = palette_generator.tree_node(1)
+            with timer('get_palette'):
+                tmp = palette_generator.get_palette(leaves,sortby,option,min_coverage,counts)
 
-        palette_generator.classes = np.ones(palette_generator.im_.shape,dtype=np.uint8)
-        palette_generator.get_mean_cov(palette_generator.tree_root)
-        for i in range(self.no_of_colors-1):
-            # get max eigenvalue node
-            m=palette_generator.get_max_eigenval_node(palette_generator.tree_root)
-            # partition class
-            palette_generator.partition_node(m,palette_generator.get_next_id(palette_generator.tree_root),palette_generator.im_.shape)
-            # get mean cov of left and right
-            palette_generator.get_mean_cov(m.left)
-            palette_generator.get_mean_cov(m.right)
+            if top!=None and top<=len(tmp) and top>=0:
+                tmp = tmp[0:top]
 
-        tmp = palette_generator.get_palette(palette_generator.get_leaf_nodes(palette_generator.tree_root),sortby,option)
+        if verbose:
+            palette_generator.print_palette([e[0] for e in tmp] if counts else tmp,img_path)
 
-        palette_generator.classes = None
-        palette_generator.im = None
-        palette_generator.im_ = None
-        palette_generator.tree_root = None
+        if stats is None:
+            return tmp
+        return tmp, stats
 
-        if top!=None and top<=len(tmp) and top>=0:
-            tmp = tmp[0:top]
+    @staticmethod
+    def no_timer(stage):
+        return contextlib.nullcontext()
 
-        if verbose:
-            print(os.path.basename(img_path))
-            for i in tmp:
-                print(termcolor.rgb_box(i,max(int(termcolor.get_term_size()[1])//len(tmp),1)),end="")
-            print()
+    @staticmethod
+    def source_name(img_path):
+        if isinstance(img_path,(str,os.PathLike)):
+            return os.fspath(img_path)
+        return "<{}>".format(type(img_path).__name__)
+
+    def generate_stacked(self, images, sortby="area", option=None, top=None, min_coverage=0.0, counts=False):
+        ''' Generate the palettes of many images in one batched clustering run
+
+        Every image is subsampled to subsampling_size and the whole stack is
+        clustered at once with split_stacked. Worth it for many small
+        images, where the per-image work of generate is dominated by
+        interpreter overhead.
+
+        Arguments:
+            images {list} -- images, anything generate accepts
+
+        Returns:
+            list -- one palette per image, in input order
+        '''
+        if not len(images):
+            return []
+        pixels = np.stack([self.load_image(im).reshape(-1,3) for im in images]).astype(np.float64)
+        means, pop, leaves = palette_generator.split_stacked(pixels,self.no_of_colors-1)
+        ret = []
+        for i in range(len(images)):
+            tmp = palette_generator.get_palette([(k+1,means[i,k],pop[i,k]) for k in range(leaves[i])],sortby,option,min_coverage,counts)
+            if top!=None and top<=len(tmp) and top>=0:
+                tmp = tmp[0:top]
+            ret.append(tmp)
+        return ret
+
+    def generate_from_raw(self, raw_path, width, height, offset=0, **kwargs):
+        ''' Generate the palette of a headerless, interleaved 8-bit RGB file
+
+        The file is memory-mapped, so with fast_load only the rows that
+        survive subsampling are ever read from disk.
+
+        Arguments:
+            raw_path {str} -- filename of the raw RGB data
+            width {int} -- image width in pixels
+            height {int} -- image height in pixels
+
+        Keyword Arguments:
+            offset {int} -- byte offset of the pixel data (default: {0})
+            kwargs -- passed on to generate
+        '''
+        im = np.memmap(raw_path,dtype=np.uint8,mode='r',offset=offset,shape=(height,width,3))
+        return self.generate(im,**kwargs)
+
+    def iter_frames(self, frames):
+        ''' Lazily iterate the frames of a sequence
+
+        Arguments:
+            frames {str|PIL.Image|bytes|iterable} -- a directory of frame
+                files (taken in name order), an animated image (GIF, APNG,
+                WebP, multi-page TIFF, ...) as anything open_image takes, or
+                an iterable of frames in any form generate takes
+
+        Returns:
+            generator -- yields the frames
+        '''
+        if isinstance(frames,(str,os.PathLike)) and os.path.isdir(frames):
+            yield from sorted(palette_generator.walk_images(frames,recursive=False))
+        elif isinstance(frames,(str,os.PathLike,bytes,bytearray,memoryview,Image.Image)) or hasattr(frames,'read'):
+            yield from ImageSequence.Iterator(self.open_image(frames))
+        else:
+            yield from frames
+
+    def iter_frame_leaves(self, frames, tolerance=4.0, stats=None):
+        ''' Cluster the frames of a sequence, warm-starting from the last tree
+
+        The first frame is split from scratch. Every later frame is first
+        clustered with the previous tree (see palette_tree.replay) and only split
+        afresh when its leaves drifted more than tolerance, in 0-255 RGB
+        units, from the frame the tree was built on, or when a leaf came out
+        empty. tolerance=0 splits every frame from scratch.
+
+        Returns:
+            generator -- yields (leaves, resplit) per frame, leaves as
+                         (classid, mean, count) tuples
+        '''
+        timer = palette_generator.no_timer if stats is None else stats.timer
+        warm = None
+        for frame in self.iter_frames(frames):
+            im_ = self.load_image(frame,stats)
+            if self.histogram:
+                pixels, weights = palette_generator.color_histogram(im_)
+            else:
+                pixels, weights = im_.reshape(-1,3).astype(np.float64), None
+            if warm!=None and tolerance>0:
+                with timer('replay'):
+                    leaves, drift = warm.replay(pixels,weights)
+                if drift<=tolerance:
+                    yield leaves, False
+                    continue
+            with timer('cluster'):
+                tree = palette_generator.split_tree(pixels,weights,stats)
+                tree.split(self.no_of_colors-1)
+                warm = palette_generator.palette_tree(tree)
+                leaves = palette_generator.get_leaf_nodes(tree.root)
+            yield leaves, True
+
+    def aggregate_leaves(self, leaves):
+        ''' Cluster the leaves of many images (or frames) into one set of
+            no_of_colors leaves, weighting every leaf mean by its pixel count
+        '''
+        means = np.array([l[1] for l in leaves],dtype=np.float64).reshape(-1,3)
+        weights = np.array([l[2] for l in leaves],dtype=np.float64)
+        tree = palette_generator.split_tree(means,weights)
+        tree.split(self.no_of_colors-1)
+        return [(i,m,int(round(c))) for (i,m,c) in palette_generator.get_leaf_nodes(tree.root)]
 
-        return tmp
+    def generate_frames(self, frames, sortby="area", option=None, top=None, min_coverage=0.0, counts=False, tolerance=4.0, stats=None):
+        ''' Generate the palettes of an animation or a sequence of frames
 
-    def generate_from_dir(self, dir_path=".", sortby="area", option=None, top=None, verbose=False):
+        Consecutive frames are usually nearly identical, so the split tree of
+        one frame is reused for the next ones until they drift away from it
+        by more than tolerance, see iter_frame_leaves.
+
+        Arguments:
+            frames {str|PIL.Image|bytes|iterable} -- see iter_frames
+
+        Keyword Arguments:
+            sortby, option, top, min_coverage, counts -- as in generate
+            tolerance {float} -- allowed mean drift of the leaf colors, in
+                                 0-255 RGB units, before a frame is split
+                                 from scratch (default: {4.0})
+            stats {palette_stats} -- collect per-stage timings, warm-started
+                                     frames are timed as 'replay'
+                                     (default: {None})
+
+        Returns:
+            tuple -- list of per-frame palettes and the aggregate palette of
+                     the whole sequence
+        '''
+        palettes = []
+        pooled = []
+        for leaves, _ in self.iter_frame_leaves(frames,tolerance,stats):
+            pooled.extend(leaves)
+            tmp = palette_generator.get_palette(leaves,sortby,option,min_coverage,counts)
+            if top!=None and top<=len(tmp) and top>=0:
+                tmp = tmp[0:top]
+            palettes.append(tmp)
+        if not pooled:
+            return palettes, []
+        aggregate = palette_generator.get_palette(self.aggregate_leaves(pooled),sortby,option,min_coverage,counts)
+        if top!=None and top<=len(aggregate) and top>=0:
+            aggregate = aggregate[0:top]
+        return palettes, aggregate
+
+    def iter_progressive(self, img_path, sortby="area", option=None, top=None, min_coverage=0.0, counts=False, deadline=None, converge=0.0, eigen_tol=0.0, start_size=8, stats=None):
+        ''' Coarse-to-fine palette generation, yielding a palette per level
+
+        The image is decoded once at subsampling_size and clustered at
+        doubling sizes from start_size up, every level with more colors (up
+        to one per 16 pixels) until the last one, which is identical to
+        generate. It stops early when
+
+            deadline -- seconds since the call have passed. Splitting is
+                        checked after every split; the first level always
+                        completes, so there is a palette to return. A level
+                        cut off with fewer colors than the previous one is
+                        dropped, the previous palette and its progress are
+                        yielded again with reason 'deadline'
+            converge -- the palette of a level moved less than this from the
+                        previous one: the count-weighted mean distance of its
+                        colors to the nearest previous color, 0-255 RGB units
+            eigen_tol -- on the last level, no leaf has a variance along
+                         its principal axis of eigen_tol or more, the image is
+                         fully explained. Coarser levels are low-pass
+                         resamples that understate the variance, there it
+                         only stops the splitting of that level
+
+        Arguments:
+            img_path {str|PIL.Image|numpy.ndarray|bytes|file} -- the image
+
+        Keyword Arguments:
+            sortby, option, top, min_coverage, counts -- as in generate
+            start_size {int} -- subsampling size of the first level
+                                (default: {8})
+
+        Returns:
+            generator -- yields (palette, progress) where progress is a dict
+                         with the level, levels, size, colors, splits,
+                         max_eigval, drift, elapsed time, whether the level
+                         completed, and reason: None while refining, then
+                         'finished', 'deadline', 'converged' or 'eigenvalue'
+        '''
+        t0 = time.perf_counter()
+        timer = palette_generator.no_timer if stats is None else stats.timer
+        full = self.load_image(img_path,stats)
+        sizes = []
+        size = min(start_size,self.subsampling_size)
+        while size<self.subsampling_size:
+            sizes.append(size)
+            size *= 2
+        sizes.append(self.subsampling_size)
+        prev = prev_palette = prev_progress = None
+        for level, size in enumerate(sizes):
+            last = level==len(sizes)-1
+            with timer('resize'):
+                im_ = full if last else np.array(Image.fromarray(full).resize((size,size),self.resample),dtype=np.uint8)
+            n_colors = self.no_of_colors if last else min(self.no_of_colors,max(2,size*size//16))
+            with timer('cluster'):
+                if self.histogram:
+                    pixels, weights = palette_generator.color_histogram(im_)
+                    tree = palette_generator.split_tree(pixels,weights,stats)
+                else:
+                    tree = palette_generator.split_tree(im_.reshape(-1,3).astype(np.float64),stats=stats)
+                splits = 0
+                reason = None
+                while splits<n_colors-1:
+                    if tree.leaf_heap and -tree.leaf_heap[0][0]<eigen_tol:
+                        break
+                    if level>0 and deadline!=None and time.perf_counter()-t0>=deadline:
+                        reason = 'deadline'
+                        break
+                    if not tree.split(1):
+                        break
+                    splits += 1
+                leaves = palette_generator.get_leaf_nodes(tree.root)
+            if reason=='deadline' and prev!=None and len(leaves)<len(prev):
+                # the unfinished level has fewer colors than the last one,
+                # which is returned again, reported as it was
+                yield prev_palette, dict(prev_progress,elapsed=time.perf_counter()-t0,reason='deadline')
+                return
+            max_eigval = -tree.leaf_heap[0][0] if tree.leaf_heap else 0.0
+            drift = None if prev==None else palette_generator.palette_drift(prev,leaves)
+            if reason==None:
+                if last:
+                    reason = 'eigenvalue' if splits<n_colors-1 and max_eigval<eigen_tol else 'finished'
+                elif drift!=None and drift<converge:
+                    reason = 'converged'
+                elif deadline!=None and time.perf_counter()-t0>=deadline:
+                    reason = 'deadline'
+            tmp = palette_generator.get_palette(leaves,sortby,option,min_coverage,counts)
+            if top!=None and top<=len(tmp) and top>=0:
+                tmp = tmp[0:top]
+            progress = {'level':level+1, 'levels':len(sizes), 'size':size, 'colors':len(leaves),
+                        'splits':splits, 'max_eigval':float(max_eigval), 'drift':drift,
+                        'elapsed':time.perf_counter()-t0, 'complete':splits==n_colors-1 or reason!='deadline',
+                        'reason':reason}
+            yield tmp, progress
+            if reason!=None:
+                return
+            prev, prev_palette, prev_progress = leaves, tmp, progress
+
+    def generate_progressive(self, img_path, deadline=None, **kwargs):
+        ''' Runs iter_progressive to the end and returns the last
+            (palette, progress), see iter_progressive for the arguments
+        '''
+        for ret in self.iter_progressive(img_path,deadline=deadline,**kwargs):
+            pass
+        return ret
+
+    @staticmethod
+    def palette_drift(old_leaves,new_leaves):
+        ''' Count-weighted mean distance, in 0-255 RGB units, of the leaf
+            colors of new_leaves to the nearest leaf color of old_leaves
+        '''
+        old = np.array([l[1] for l in old_leaves],dtype=np.float64).reshape(-1,3)
+        new = np.array([l[1] for l in new_leaves],dtype=np.float64).reshape(-1,3)
+        w = np.array([l[2] for l in new_leaves],dtype=np.float64)
+        d = np.sqrt(color.metric.pairwise_distance(new,old).min(1))
+        return float(np.dot(w,d)/w.sum())
+
+    def get_leaves(self, img_path, stats=None):
+        ''' Cluster an image and return its unsorted leaves as
+            (classid, mean, count) tuples
+        '''
+        tree = self.build_tree(img_path,stats)
+        return palette_generator.get_leaf_nodes(tree.root)
+
+    def build_tree(self, img_path, stats=None):
+        ''' Cluster the subsampled image, returns the finished split_tree '''
+        timer = palette_generator.no_timer if stats is None else stats.timer
+        im_ = self.load_image(img_path,stats)
+        with timer('cluster'):
+            if self.histogram:
+                pixels, weights = palette_generator.color_histogram(im_)
+                tree = palette_generator.split_tree(pixels,weights,stats)
+            else:
+                tree = palette_generator.split_tree(im_.reshape(-1,3).astype(np.float64),stats=stats)
+            tree.split(self.no_of_colors-1)
+            return tree
+
+    def fit(self, img_path, stats=None):
+        ''' Cluster an image and keep the tree
+
+        Returns:
+            palette_tree -- the compact split tree, its leaves() are what
+                            generate sorts into the palette
+        '''
+        return palette_generator.palette_tree(self.build_tree(img_path,stats))
+
+    def quantize(self, img_path, colors=False, out=None, max_memory=64<<20, stats=None):
+        ''' Quantize an image at full resolution to its own palette
+
+        The palette is learned on the subsampled image as in generate, then
+        every pixel of the full image is remapped with the split tree in
+        bounded chunks of rows (see palette_tree.remap). Files are decoded
+        only once.
+
+        Arguments:
+            img_path {str|PIL.Image|numpy.ndarray|bytes|file} -- the image
+
+        Keyword Arguments:
+            colors {bool} -- output palette colors instead of indices
+                             (default: {False})
+            out {numpy.ndarray} -- output array, e.g. a memmap
+                                   (default: {None})
+            max_memory {int} -- working set of a chunk in bytes
+                                (default: {64 MiB})
+            stats {palette_stats} -- collect per-stage timings
+                                     (default: {None})
+
+        Returns:
+            tuple -- the (H,W) palette indices or (H,W,3) colors, the exact
+                     pixel count of every palette color and the palette_tree,
+                     whose colors() is the palette in index order
+        '''
+        if isinstance(img_path,(str,os.PathLike)) and not os.path.isfile(img_path):
+            raise Exception("Image file not found")
+        timer = palette_generator.no_timer if stats is None else stats.timer
+        full = img_path
+        if not isinstance(full,np.ndarray):
+            with timer('decode'):
+                full = self.open_image(full)
+                full.load()
+                if full.mode!='RGB':
+                    full = full.convert('RGB')
+        tree = self.fit(full,stats)
+        with timer('remap'):
+            out, counts = tree.remap(full,out,colors,max_memory)
+        return out, counts, tree
+
+    def quantize_raw(self, raw_path, width, height, offset=0, out_path=None, colors=False, max_memory=64<<20):
+        ''' quantize for a headerless, interleaved 8-bit RGB file
+
+        The input is memory-mapped and so is the output when out_path is
+        given. Fitting resamples the input one band of rows at a time (see
+        resize_array) and remapping works in chunks of rows, so besides the
+        mapped file pages, which are page cache the kernel can drop, only
+        about max_memory bytes of working set are ever allocated. Without
+        fast_load every input page is read twice, once for each pass.
+
+        Arguments:
+            raw_path {str} -- filename of the raw RGB data
+            width {int} -- image width in pixels
+            height {int} -- image height in pixels
+
+        Keyword Arguments:
+            offset {int} -- byte offset of the pixel data (default: {0})
+            out_path {str} -- write the result there, as raw uint8 indices
+                              (uint16 beyond 256 colors) or RGB colors
+                              (default: {None})
+        '''
+        im = np.memmap(raw_path,dtype=np.uint8,mode='r',offset=offset,shape=(height,width,3))
+        out = None
+        if out_path!=None:
+            shape = (height,width,3) if colors else (height,width)
+            dtype = np.uint8 if colors or self.no_of_colors<=256 else np.uint16
+            out = np.memmap(out_path,dtype=dtype,mode='w+',shape=shape)
+        out, counts, tree = self.quantize(im,colors,out,max_memory)
+        if out_path!=None:
+            out.flush()
+        return out, counts, tree
+
+    @staticmethod
+    def color_histogram(im_):
+        ''' Reduce an image to its unique colors and their pixel counts
+
+        Arguments:
+            im_ {numpy.ndarray} -- uint8 array of shape (...,3)
+
+        Returns:
+            tuple -- float array (U,3) of colors and float array (U,) of counts
+        '''
+        px = im_.reshape(-1,3).astype(np.uint32)
+        keys, counts = np.unique((px[:,0]<<16)|(px[:,1]<<8)|px[:,2],return_counts=True)
+        colors = np.stack(((keys>>16)&255,(keys>>8)&255,keys&255),1)
+        return colors.astype(np.float64), counts.astype(np.float64)
+
+    def cache_params(self):
+        # everything besides the image itself that the leaves depend on
+        return "v{}:{}:{}:{}:{}".format(palette_generator.algorithm_version,self.no_of_colors,
+                                        self.subsampling_size,int(self.fast_load),int(self.resample))
+
+    class memory_file(io.RawIOBase):
+        ''' Read-only, seekable file over any buffer, without copying it '''
+        def __init__(self,buf):
+            self.buf = memoryview(buf).cast('B')
+            self.pos = 0
+
+        def readable(self):
+            return True
+
+        def seekable(self):
+            return True
+
+        def readinto(self,b):
+            n = min(len(b),len(self.buf)-self.pos)
+            b[:n] = self.buf[self.pos:self.pos+n]
+            self.pos += n
+            return n
+
+        def seek(self,offset,whence=io.SEEK_SET):
+            if whence==io.SEEK_CUR:
+                offset += self.pos
+            elif whence==io.SEEK_END:
+                offset += len(self.buf)
+            self.pos = max(0,offset)
+            return self.pos
+
+        def tell(self):
+            return self.pos
+
+    def open_image(self, img_path):
+        ''' Returns a PIL.Image for any source accepted by generate '''
+        if isinstance(img_path,np.ndarray):
+            im = img_path
+            if self.fast_load:
+                # nearest-neighbour pre-subsampling, only touches the rows kept
+                factor = min(im.shape[:2])//(2*self.subsampling_size)
+                if factor>1:
+                    im = im[::factor,::factor]
+            return Image.fromarray(np.ascontiguousarray(im))
+        if isinstance(img_path,Image.Image):
+            return img_path
+        if isinstance(img_path,bytes):
+            # BytesIO shares the memory of an immutable bytes object
+            return Image.open(io.BytesIO(img_path))
+        if isinstance(img_path,(bytearray,memoryview)):
+            return Image.open(palette_generator.memory_file(img_path))
+        return Image.open(img_path)
+
+    def load_image(self, img_path, stats=None):
+        ''' Decode an image and subsample it to subsampling_size x
+            subsampling_size
+
+        With fast_load, JPEGs are decoded in draft mode at the smallest DCT
+        scale (1/2, 1/4 or 1/8) that still covers the target size, and other
+        formats are box-reduced by an integer factor before the final resample,
+        so the full resolution image never has to be held in memory.
+
+        Arguments:
+            img_path {str|PIL.Image|numpy.ndarray|bytes|file} -- the image, see
+                                                                generate
+
+        Returns:
+            numpy.ndarray -- uint8 array of shape (size,size,3)
+        '''
+        timer = palette_generator.no_timer if stats is None else stats.timer
+        size = self.subsampling_size
+        if isinstance(img_path,np.ndarray) and not self.fast_load:
+            with timer('resize'):
+                return self.resize_array(img_path,size)
+        with timer('decode'):
+            im = self.open_image(img_path)
+            if self.fast_load:
+                im.draft('RGB',(size,size))
+            im.load()
+            # an image that already is RGB, e.g. the one quantize decoded, is
+            # resampled as is rather than copied by convert
+            if im.mode!='RGB':
+                im = im.convert('RGB')
+        with timer('resize'):
+            if self.fast_load:
+                # keep at least twice the target size for the resampling filter
+                factor = min(im.size)//(2*size)
+                if factor>1:
+                    im = im.reduce(factor)
+            return np.array(im.resize((size,size),self.resample), dtype=np.uint8)
+
+    def resize_array(self, im, size, max_memory=64<<20):
+        ''' Resample an array image to size x size, one band of rows at a time
+
+        Every band of output rows is resampled from just the input rows under
+        the filter, so only those are ever converted to a PIL image, and the
+        result is the same as resizing the whole image. With a numpy.memmap
+        the image is read once, chunk by chunk.
+
+        Arguments:
+            im {numpy.ndarray} -- anything Image.fromarray takes
+            size {int} -- width and height of the result
+
+        Keyword Arguments:
+            max_memory {int} -- working set of a band in bytes
+                                (default: {64 MiB})
+
+        Returns:
+            numpy.ndarray -- uint8 array of shape (size,size,3)
+        '''
+        H, W = im.shape[:2]
+        scale = H/size
+        # input rows under the widest filter (Lanczos, 3 lobes) on either side
+        margin = int(3*max(scale,1.0))+2
+        # the band as array, as PIL image and converted take about 12 bytes
+        # per pixel
+        band = max(1,int((max_memory/(12*W)-2*margin)/scale))
+        out = np.empty((size,size,3),dtype=np.uint8)
+        for y0 in range(0,size,band):
+            y1 = min(size,y0+band)
+            top = max(0,y0*H//size-margin)
+            bottom = min(H,-(-y1*H//size)+margin)
+            chunk = Image.fromarray(np.ascontiguousarray(im[top:bottom]))
+            if chunk.mode!='RGB':
+                chunk = chunk.convert('RGB')
+            box = (0,y0*H/size-top,W,y1*H/size-top)
+            out[y0:y1] = np.asarray(chunk.resize((size,y1-y0),self.resample,box=box))
+        return out
+
+    @staticmethod
+    def print_palette(palette,img_path,renderer=None):
+        if renderer==None:
+            renderer = palette_renderer()
+        renderer.write(palette,os.path.basename(palette_generator.source_name(img_path)))
+
+    def generate_parallel(self, img_paths, sortby="area", option=None, top=None, jobs=None, chunksize=1, ordered=True, max_pending=None, errors="raise", **kwargs):
+        ''' Generate palettes for many images on a pool of worker processes
+
+        img_paths is consumed lazily and only a bounded number of chunks is in
+        flight at any time, so at most that many images are decoded at once
+        no matter how long the input is.
+
+        Arguments:
+            img_paths {iterable} -- image filenames
+
+        Keyword Arguments:
+            jobs {int} -- number of worker processes, all cores if None and no
+                          pool at all if 1 (default: {None})
+            chunksize {int} -- number of images handed to a worker at once
+                               (default: {1})
+            ordered {bool} -- yield results in input order, otherwise as soon
+                              as each one completes (default: {True})
+            max_pending {int} -- maximum number of chunks in flight
+                                 (default: {2*jobs})
+            errors {str} -- "raise" stops at the first image that fails,
+                            "return" yields the exception in place of its
+                            palette and carries on (default: {"raise"})
+            kwargs -- passed on to generate
+
+        Returns:
+            generator -- yields (img_path, palette) tuples
+        '''
+        if jobs==1:
+            for f in img_paths:
+                try:
+                    r = self.generate(f,sortby,option,top,**kwargs)
+                except Exception as e:
+                    if errors!="return":
+                        raise
+                    r = e
+                yield (f, r)
+            return
+        stats = kwargs.get('stats')
+        if isinstance(stats,palette_stats):
+            # every image collects its own stats in the worker, they are
+            # merged back into the caller's object here
+            kwargs = dict(kwargs,stats=palette_stats(stats.trace_memory))
+        jobs = jobs or os.cpu_count() or 1
+        max_pending = max_pending or 2*jobs
+        paths = iter(img_paths)
+        # every worker unpickles the generator, and opens its cache, once
+        with concurrent.futures.ProcessPoolExecutor(jobs,initializer=_init_worker,initargs=(self,)) as pool:
+            pending = deque()
+            while True:
+                chunk = list(itertools.islice(paths,chunksize))
+                if chunk:
+                    pending.append(pool.submit(_generate_chunk,chunk,sortby,option,top,kwargs,errors))
+                if not pending:
+                    break
+                if chunk and len(pending)<max_pending:
+                    continue
+                if ordered:
+                    done = [pending.popleft()]
+                else:
+                    done, _ = concurrent.futures.wait(pending,return_when=concurrent.futures.FIRST_COMPLETED)
+                    for d in done:
+                        pending.remove(d)
+                for d in done:
+                    results, hits, misses = d.result()
+                    # the workers count on their own copies of the cache
+                    if self.cache!=None:
+                        self.cache.count(hits,misses)
+                    for f, r in results:
+                        if isinstance(stats,palette_stats) and not isinstance(r,Exception):
+                            r = (r[0], stats.merge(r[1]))
+                        yield (f, r)
+
+    @staticmethod
+    def image_extensions():
+        ''' Returns the set of lowercase file extensions PIL can open '''
+        Image.init()
+        return set(ext for ext, fmt in Image.registered_extensions().items() if fmt in Image.OPEN)
+
+    @staticmethod
+    def walk_images(dir_path=".", recursive=True, include=None, exclude=None, extensions=None):
+        ''' Lazily walk a directory tree for image files
+
+        Arguments:
+            dir_path {str} -- directory to walk
+
+        Keyword Arguments:
+            recursive {bool} -- descend into subdirectories (default: {True})
+            include {list} -- glob patterns, matched against the path relative
+                              to dir_path, of which one must match
+                              (default: {None})
+            exclude {list} -- glob patterns of paths to skip (default: {None})
+            extensions {set} -- lowercase extensions to accept, everything PIL
+                                can open if None (default: {None})
+
+        Returns:
+            generator -- yields image paths
+        '''
+        if not os.path.isdir(dir_path):
+            raise Exception("Directory not found")
+        if extensions==None:
+            extensions = palette_generator.image_extensions()
+        stack = [dir_path]
+        while stack:
+            with os.scandir(stack.pop()) as it:
+                for entry in it:
+                    if entry.is_dir(follow_symlinks=False):
+                        if recursive:
+                            stack.append(entry.path)
+                        continue
+                    if os.path.splitext(entry.name)[1].lower() not in extensions:
+                        continue
+                    rel = os.path.relpath(entry.path,dir_path)
+                    if include and not any(fnmatch.fnmatch(rel,pat) for pat in include):
+                        continue
+                    if exclude and any(fnmatch.fnmatch(rel,pat) for pat in exclude):
+                        continue
+                    if entry.is_file():
+                        yield entry.path
+
+    def iter_dir(self, dir_path=".", sortby="area", option=None, top=None, recursive=True, include=None, exclude=None, extensions=None, jobs=1, chunksize=1, ordered=False, **kwargs):
+        ''' Streaming version of generate_from_dir
+
+        Walks dir_path with walk_images and yields (path, palette) as each
+        image is done, keeping only a bounded number of decoded images in
+        memory (see generate_parallel).
+        '''
+        paths = palette_generator.walk_images(dir_path,recursive,include,exclude,extensions)
+        return self.generate_parallel(paths,sortby,option,top,jobs,chunksize,ordered,**kwargs)
+
+    def generate_from_dir(self, dir_path=".", sortby="area", option=None, top=None, verbose=False, jobs=1, chunksize=1, stats=None):
         if not os.path.isdir(dir_path):
             raise Exception("Directory not found")
             return
-        ret = []
+        files = []
         for f in os.listdir(dir_path):
             f_ = f.lower()
             if (f_.endswith(".jpg") or f_.endswith(".jpeg") or f_.endswith(".png")):
-                tmp = self.generate(dir_path+"/"+f,sortby,option)
-                if top!=None and top<=len(tmp[0]) and top>=0:
-                    tmp[0] = tmp[0][0:top]
-                ret.append((tmp,f))
-                if verbose:
-                    print(os.path.basename(f))
-                    for i in ret[-1][0]:
-                        print(termcolor.rgb_box(i,max(int(termcolor.get_term_size()[1])//len(tmp),1)),end="")
-                    print()
-        return ret
+                files.append(f)
+        ret = []
+        paths = [dir_path+"/"+f for f in files]
+        if stats is True:
+            stats = palette_stats()
+        kwargs = {} if stats is None else {'stats':stats}
+        renderer = palette_renderer() if verbose else None
+        for f, (_, tmp) in zip(files,self.generate_parallel(paths,sortby,option,top,jobs,chunksize,**kwargs)):
+            if stats is not None:
+                tmp = tmp[0]
+            ret.append((tmp,f))
+            if verbose:
+                palette_generator.print_palette(tmp,f,renderer)
+        if stats is None:
+            return ret
+        return ret, stats
+
+
+_worker_generator = None
+
+def _init_worker(generator):
+    global _worker_generator
+    _worker_generator = generator
+
+def _generate_chunk(img_paths, sortby, option, top, kwargs, errors="raise"):
+    # module level so that it can be pickled for the process pool, returns the
+    # results with the cache hits and misses of the chunk
+    generator = _worker_generator
+    cache = generator.cache
+    hits, misses = (cache.hits, cache.misses) if cache!=None else (0, 0)
+    ret = []
+    for f in img_paths:
+        if isinstance(kwargs.get('stats'),palette_stats):
+            kwargs = dict(kwargs,stats=palette_stats(kwargs['stats'].trace_memory))
+        try:
+            ret.append((f, generator.generate(f,sortby,option,top,**kwargs)))
+        except Exception as e:
+            if errors!="return":
+                raise
+            ret.append((f, e))
+    if cache==None:
+        return ret, 0, 0
+    cache.flush()
+    return ret, cache.hits-hits, cache.misses-misses
+
+
+SORT_ORDERS = ["area","saturation","value","saturation+value","standard_deviation","distance_from_gray","eye_catching","nearest_to"]
+
+def parse_color(s):
+    ''' "#rrggbb" or "R,G,B" to an (R,G,B) tuple '''
+    try:
+        if s.startswith("#") and len(s)==7:
+            return tuple(int(s[i:i+2],16) for i in (1,3,5))
+        c = tuple(int(x) for x in s.split(","))
+        if len(c)==3:
+            return c
+    except ValueError:
+        pass
+    raise argparse.ArgumentTypeError("expected #rrggbb or R,G,B, got {!r}".format(s))
+
+def iter_paths(inputs, stdin=None, **walk_args):
+    ''' Expand the command line inputs lazily into image paths
+
+    Directories are walked with palette_generator.walk_images and "-" stands
+    for a list of paths, one per line, on stdin.
+    '''
+    for f in inputs:
+        if f=="-":
+            for line in (stdin or sys.stdin):
+                line = line.rstrip("\r\n")
+                if line:
+                    yield line
+        elif os.path.isdir(f):
+            yield from palette_generator.walk_images(f,**walk_args)
+        else:
+            yield f
+
+def main(argv=None):
+    ''' Command line entry point, see python -m palettely --help '''
+    parser = argparse.ArgumentParser(prog="python -m palettely",
+        description="Generate color palettes of images. Writes one JSON line per image, "
+                    "as soon as it is done, with the palette as HTML hex codes.")
+    parser.add_argument("paths",nargs="*",default=["-"],
+                        help="image files or directories, - (the default) reads paths from stdin")
+    parser.add_argument("-n","--output-colors",type=int,default=20,help="number of clusters (default: 20)")
+    parser.add_argument("-s","--subsampling-size",type=int,default=24,help="side of the subsampled image (default: 24)")
+    parser.add_argument("--sortby",choices=SORT_ORDERS,default="area",help="palette order (default: area)")
+    parser.add_argument("--option",type=parse_color,help="target color of --sortby nearest_to, #rrggbb or R,G,B")
+    parser.add_argument("-t","--top",type=int,help="only output the first TOP colors")
+    parser.add_argument("--min-coverage",type=float,default=0.0,help="drop colors covering less than this fraction of the image")
+    parser.add_argument("--counts",action="store_true",help="also output the pixel count of every color")
+    parser.add_argument("-j","--jobs",type=int,default=1,help="worker processes, 0 for one per core (default: 1)")
+    parser.add_argument("--chunksize",type=int,default=1,help="images handed to a worker at once (default: 1)")
+    parser.add_argument("--ordered",action="store_true",help="output in input order instead of as completed")
+    parser.add_argument("--no-recursive",dest="recursive",action="store_false",help="do not descend into subdirectories")
+    parser.add_argument("--include",action="append",help="glob of the paths to take from directories, repeatable")
+    parser.add_argument("--exclude",action="append",help="glob of the paths to skip in directories, repeatable")
+    parser.add_argument("--fast-load",action="store_true",help="decode close to the subsampling size")
+    parser.add_argument("--histogram",action="store_true",help="cluster unique colors weighted by their counts")
+    parser.add_argument("--cache",metavar="DB",help="SQLite palette cache to read and fill")
+    args = parser.parse_args(argv)
+    if args.sortby=="nearest_to" and args.option==None:
+        parser.error("--sortby nearest_to needs --option")
+
+    # when run as python -m palettely this module is __main__, the classes
+    # are taken from the package so worker processes can unpickle them
+    from palettely import palette_generator, palette_cache
+    from palettely.color_wheel import color
+
+    cache = palette_cache(args.cache) if args.cache else None
+    p = palette_generator(args.output_colors,args.subsampling_size,fast_load=args.fast_load,cache=cache,histogram=args.histogram)
+    paths = iter_paths(args.paths,recursive=args.recursive,include=args.include,exclude=args.exclude)
+    results = p.generate_parallel(paths,args.sortby,args.option,args.top,jobs=args.jobs or None,
+                                  chunksize=args.chunksize,ordered=args.ordered,errors="return",
+                                  min_coverage=args.min_coverage,counts=args.counts)
+    failed = 0
+    try:
+        for f, r in results:
+            if isinstance(r,Exception):
+                failed += 1
+                line = {"path":f, "error":str(r) or type(r).__name__}
+            elif args.counts:
+                line = {"path":f, "palette":[color.to_hex(*c) for c, _ in r], "counts":[n for _, n in r]}
+            else:
+                line = {"path":f, "palette":[color.to_hex(*c) for c in r]}
+            sys.stdout.write(json.dumps(line)+"\n")
+            sys.stdout.flush()
+    except BrokenPipeError:
+        # the reader went away, e.g. | head
+        sys.stdout = open(os.devnull,"w")
+        return 1
+    except KeyboardInterrupt:
+        return 130
+    finally:
+        if cache!=None:
+            cache.close()
+    return 1 if failed else 0
+
+if __name__=="__main__":
+    sys.exit(main())
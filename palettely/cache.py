@@ -0,0 +1,206 @@
+'''
+                 _
+  __ __ _ __| |_  ___
+ / _/ _` / _| ' \/ -_)
+ \__\__,_\__|_||_\___|
+
+'''
+
+import hashlib
+import os
+import sqlite3
+import struct
+import threading
+import time
+
+class palette_cache:
+    ''' Persistent palette cache
+
+    Stores the unsorted leaf colors and pixel counts of every image clustered
+    by a palette_generator in a single SQLite file, so any sortby/top can be
+    served again without decoding or clustering the image. Entries are keyed
+    on the SHA-1 of the file contents together with the generator parameters
+    and algorithm version. The (path, mtime, size) of every file seen is
+    remembered as well, so unchanged files are not even re-hashed.
+
+    The least recently used entries are evicted once the cache holds more
+    than max_entries palettes, down to 99% of it. The entry count is kept
+    along instead of counted on every put, and recounted once it passes
+    max_entries. Recency only needs to be roughly right for that: a hit
+    marks its entry as used only if it was last used more than
+    touch_interval seconds ago, and these marks are buffered and written
+    together on put, flush and close, or once touch_batch are waiting.
+
+    A cache can be shared by the threads of one process: they use a single
+    connection, one at a time, and files are hashed outside of the lock.
+
+    Usage example:
+    cache = palette_cache("~/.palettes.sqlite")
+    p = palette_generator(45,cache=cache)
+    p.generate_from_dir("~",top=20)
+    print(cache.hits, cache.misses)
+    cache.close()
+    '''
+
+    def __init__(self,db_path,max_entries=1000000,touch_interval=3600.0,touch_batch=256):
+        self.db_path = os.path.expanduser(db_path)
+        self.max_entries = max_entries
+        self.touch_interval = touch_interval
+        self.touch_batch = touch_batch
+        self.hits = 0
+        self.misses = 0
+        self._db = None
+        self._entries = None
+        self._touched = {}
+        self._lock = threading.RLock()
+
+    # the sqlite connection is reopened on the other side when the cache is
+    # handed to worker processes
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_db'] = None
+        state['_entries'] = None
+        state['_touched'] = {}
+        del state['_lock']
+        return state
+
+    def __setstate__(self,state):
+        self.__dict__.update(state)
+        self._lock = threading.RLock()
+
+    @property
+    def db(self):
+        # callers hold self._lock
+        if self._db==None:
+            self._db = sqlite3.connect(self.db_path,timeout=60,check_same_thread=False)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("CREATE TABLE IF NOT EXISTS files ("
+                             "path TEXT PRIMARY KEY, mtime INTEGER, size INTEGER, digest TEXT)")
+            self._db.execute("CREATE TABLE IF NOT EXISTS palettes ("
+                             "digest TEXT, params TEXT, leaves BLOB, last_used REAL, "
+                             "PRIMARY KEY (digest, params))")
+            self._db.execute("CREATE INDEX IF NOT EXISTS palettes_lru ON palettes (last_used)")
+            self._db.commit()
+            self._entries = self._db.execute("SELECT COUNT(*) FROM palettes").fetchone()[0]
+        return self._db
+
+    def flush(self):
+        ''' Writes the buffered last_used updates of get in one transaction '''
+        with self._lock:
+            if self._touched:
+                with self.db:
+                    self.db.executemany("UPDATE palettes SET last_used=? WHERE digest=? AND params=?",
+                                        [(t,d,p) for (d,p), t in self._touched.items()])
+                self._touched.clear()
+
+    def close(self):
+        with self._lock:
+            if self._db!=None:
+                self.flush()
+                self._db.close()
+                self._db = None
+
+    @staticmethod
+    def hash_file(img_path,blocksize=1<<20):
+        h = hashlib.sha1()
+        with open(img_path,'rb') as f:
+            for block in iter(lambda: f.read(blocksize),b''):
+                h.update(block)
+        return h.hexdigest()
+
+    @staticmethod
+    def hash_buffer(buf):
+        return hashlib.sha1(memoryview(buf).cast('B')).hexdigest()
+
+    def digest(self,img_path):
+        ''' Returns the content hash of a file, re-hashing it only if its
+            mtime or size changed since it was last seen
+        '''
+        path = os.path.abspath(img_path)
+        st = os.stat(path)
+        with self._lock:
+            row = self.db.execute("SELECT mtime, size, digest FROM files WHERE path=?",(path,)).fetchone()
+        if row!=None and row[0]==st.st_mtime_ns and row[1]==st.st_size:
+            return row[2]
+        digest = palette_cache.hash_file(path)
+        with self._lock, self.db:
+            self.db.execute("INSERT OR REPLACE INTO files VALUES (?,?,?,?)",
+                            (path,st.st_mtime_ns,st.st_size,digest))
+        return digest
+
+    @staticmethod
+    def pack(leaves):
+        # 3 doubles for the mean and one for the count per leaf
+        values = []
+        for (_,m,n) in leaves:
+            values.extend((m[0],m[1],m[2],n))
+        return struct.pack("<%dd" % len(values),*values)
+
+    @staticmethod
+    def unpack(blob):
+        values = struct.unpack("<%dd" % (len(blob)//8),blob)
+        return [(i//4+1,values[i:i+3],int(values[i+3])) for i in range(0,len(values),4)]
+
+    def get(self,digest,params):
+        ''' Returns the cached leaves as (classid, mean, count) tuples, or None
+
+        Arguments:
+            digest {str} -- content hash of the image, see digest()
+            params {str} -- generator parameters the leaves depend on
+        '''
+        with self._lock:
+            row = self.db.execute("SELECT leaves, last_used FROM palettes WHERE digest=? AND params=?",
+                                  (digest,params)).fetchone()
+            if row==None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            now = time.time()
+            if now-row[1]>self.touch_interval:
+                self._touched[(digest,params)] = now
+                if len(self._touched)>=self.touch_batch:
+                    self.flush()
+        return palette_cache.unpack(row[0])
+
+    def put(self,digest,params,leaves):
+        blob = palette_cache.pack(leaves)
+        with self._lock:
+            self.flush()
+            with self.db:
+                values = (blob,time.time(),digest,params)
+                if not self.db.execute("UPDATE palettes SET leaves=?, last_used=? WHERE digest=? AND params=?",values).rowcount:
+                    self.db.execute("INSERT INTO palettes (leaves,last_used,digest,params) VALUES (?,?,?,?)",values)
+                    self._entries += 1
+                if self._entries>self.max_entries:
+                    # other processes may have added entries as well
+                    n = self.db.execute("SELECT COUNT(*) FROM palettes").fetchone()[0]
+                    if n>self.max_entries:
+                        evict = n-self.max_entries+self.max_entries//100
+                        self.db.execute("DELETE FROM palettes WHERE rowid IN "
+                                        "(SELECT rowid FROM palettes ORDER BY last_used LIMIT ?)",(evict,))
+                        n -= evict
+                    self._entries = n
+
+    def clear(self):
+        with self._lock:
+            with self.db:
+                self.db.execute("DELETE FROM palettes")
+                self.db.execute("DELETE FROM files")
+            self._entries = 0
+            self._touched.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def count(self,hits,misses):
+        ''' Adds hits and misses counted elsewhere, e.g. in worker processes '''
+        with self._lock:
+            self.hits += hits
+            self.misses += misses
+
+    def __len__(self):
+        with self._lock:
+            return self.db.execute("SELECT COUNT(*) FROM palettes").fetchone()[0]
+
+    def stats(self):
+        ''' Returns a dict with hit/miss counters and the number of entries '''
+        return {"hits":self.hits, "misses":self.misses, "entries":len(self)}
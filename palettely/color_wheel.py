@@ -16,6 +16,119 @@ class color_wheel:
         Contains functions for all various harmony schemes
     '''
 
+    @staticmethod
+    def rgb_to_hsv_array(rgb):
+        ''' Vectorized colorsys.rgb_to_hsv
+
+        Arguments:
+            rgb {numpy.ndarray} -- (...,3) array, 0.0-1.0 RGB values
+
+        Returns:
+            numpy.ndarray -- (...,3) array of float HSV values, identical to
+                             colorsys.rgb_to_hsv
+        '''
+        import numpy as np
+        rgb = np.asarray(rgb,dtype=np.float64)
+        r, g, b = rgb[...,0], rgb[...,1], rgb[...,2]
+        maxc = np.maximum(np.maximum(r,g),b)
+        minc = np.minimum(np.minimum(r,g),b)
+        rangec = maxc-minc
+        gray = minc==maxc
+        with np.errstate(divide='ignore',invalid='ignore'):
+            s = np.where(gray,0.0,rangec/maxc)
+            rc = (maxc-r)/rangec
+            gc = (maxc-g)/rangec
+            bc = (maxc-b)/rangec
+        h = np.where(r==maxc,bc-gc,np.where(g==maxc,2.0+rc-bc,4.0+gc-rc))
+        h = np.where(gray,0.0,np.remainder(h/6.0,1.0))
+        return np.stack((h,s,maxc),-1)
+
+    @staticmethod
+    def hsv_to_rgb_array(hsv):
+        ''' Vectorized colorsys.hsv_to_rgb
+
+        Arguments:
+            hsv {numpy.ndarray} -- (...,3) array of HSV values
+
+        Returns:
+            numpy.ndarray -- (...,3) array of 0.0-1.0 RGB values, identical to
+                             colorsys.hsv_to_rgb
+        '''
+        import numpy as np
+        hsv = np.asarray(hsv,dtype=np.float64)
+        h, s, v = hsv[...,0], hsv[...,1], hsv[...,2]
+        i = np.trunc(h*6.0)
+        f = (h*6.0)-i
+        p = v*(1.0-s)
+        q = v*(1.0-s*f)
+        t = v*(1.0-s*(1.0-f))
+        i = np.remainder(i.astype(np.int64),6)
+        r = np.choose(i,(v,q,p,p,t,v))
+        g = np.choose(i,(t,v,v,q,p,p))
+        b = np.choose(i,(p,p,t,v,v,q))
+        gray = s==0.0
+        return np.stack((np.where(gray,v,r),np.where(gray,v,g),np.where(gray,v,b)),-1)
+
+    @staticmethod
+    def split_complementary_array(rgb,n=2,spacing=72):
+        ''' Split Complementary Harmony of many colors at once
+
+        Arguments:
+            rgb {numpy.ndarray} -- (N,3) array, 0-255 RGB values
+
+        Keyword Arguments:
+            n {number} -- Number of colors to return (default: {2})
+            spacing {number} -- Spacing, in degrees, between any two consecutive
+                                split complementary colors on color wheel
+                                (default: {72})
+
+        Returns:
+            numpy.ndarray -- (N,n,3) integer array, row i holds the split
+                             complementary colors of rgb[i]
+        '''
+        import numpy as np
+        spacing %= 360
+        spacing /= 360
+        hsv = color_wheel.rgb_to_hsv_array(np.asarray(rgb).reshape(-1,3)/255.0)
+        comp_hue = 0.5+hsv[:,0]
+        comp_hue = np.where(comp_hue>1.0,comp_hue-1.0,comp_hue)
+        if (n%2):
+            # n is odd
+            start = comp_hue-((n-1)/2)*spacing
+        else:
+            # n is even
+            start = comp_hue-(spacing/2)-(n/2-1)*spacing
+        start = np.where(start<0.0,start+1.0,start)
+        hues = np.empty((hsv.shape[0],n))
+        for i in range(n):
+            hues[:,i] = start
+            start = start+spacing
+            start = np.where(start>1.0,start-1.0,np.where(start<0.0,start+1.0,start))
+        ret = color_wheel.hsv_to_rgb_array(np.stack(np.broadcast_arrays(hues,hsv[:,1,None],hsv[:,2,None]),-1))
+        # int() truncation like the scalar path, which for hues pushed far out
+        # of range can leave 0-255
+        return np.trunc(ret*255).astype(np.int64)
+
+    @staticmethod
+    def complementary_array(rgb):
+        ''' Complementary Harmony of an (N,3) array, returns (N,1,3) '''
+        return color_wheel.split_complementary_array(rgb,n=1)
+
+    @staticmethod
+    def triadic_array(rgb):
+        ''' Triadic Harmony of an (N,3) array, returns (N,2,3) '''
+        return color_wheel.split_complementary_array(rgb,n=2,spacing=120)
+
+    @staticmethod
+    def tetradic_array(rgb):
+        ''' Tetradic Harmony of an (N,3) array, returns (N,3,3) '''
+        return color_wheel.split_complementary_array(rgb,n=3,spacing=90)
+
+    @staticmethod
+    def analogous_array(rgb,spacing=72):
+        ''' Analogous Harmony of an (N,3) array, returns (N,2,3) '''
+        return color_wheel.split_complementary_array(rgb,n=2,spacing=360-spacing)
+
     @staticmethod
     def complementary(R,G,B):
         ''' Complmentary Harmony, also called Direct Harmony
@@ -177,7 +290,7 @@ class color:
             Returns:
                 double -- 0.0-1.0, double value
             '''
-            return colorsys.rgb_to_hsv(R/255.0, G/255.0, B/255.0)[0]
+            return colorsys.rgb_to_hsv(R/255.0, G/255.0, B/255.0)[1]
 
         @staticmethod
         def normalized_value(R,G,B):
@@ -207,7 +320,7 @@ class color:
                 double -- standard deviation
             '''
             mean = (R+G+B)/3
-            return ((R-mean)**2+(G-mean)**2+(B-mean)**2)
+            return (((R-mean)**2+(G-mean)**2+(B-mean)**2)/3)**0.5
 
         @staticmethod
         def color_distance(R,G,B,R_t,G_t,B_t):
@@ -226,4 +339,61 @@ class color:
             Returns:
                 double -- Distance metric
             '''
-            return ((R-R_t)**2+(G-G_t)**2+(B-B_t)**2)
\ No newline at end of file
+            return ((R-R_t)**2+(G-G_t)**2+(B-B_t)**2)
+
+        @staticmethod
+        def normalized_saturation_array(rgb):
+            ''' Normalized saturation of an (N,3) array of 0-255 RGB colors
+
+            Returns:
+                numpy.ndarray -- (N,) 0.0-1.0 values
+            '''
+            import numpy as np
+            return color_wheel.rgb_to_hsv_array(np.asarray(rgb).reshape(-1,3)/255.0)[:,1]
+
+        @staticmethod
+        def normalized_value_array(rgb):
+            ''' Normalized value of an (N,3) array of 0-255 RGB colors
+
+            Returns:
+                numpy.ndarray -- (N,) 0.0-1.0 values
+            '''
+            import numpy as np
+            return np.asarray(rgb).reshape(-1,3).max(1)/255.0
+
+        @staticmethod
+        def standard_deviation_array(rgb):
+            ''' Standard deviation between the Red, Green and Blue values of
+                an (N,3) array of colors
+
+            Returns:
+                numpy.ndarray -- (N,) standard deviations
+            '''
+            import numpy as np
+            return np.asarray(rgb,dtype=np.float64).reshape(-1,3).std(1)
+
+        @staticmethod
+        def color_distance_array(rgb,target):
+            ''' Distance of every color of an (N,3) array from one target
+                color, same metric as color_distance
+
+            Returns:
+                numpy.ndarray -- (N,) distances
+            '''
+            import numpy as np
+            d = np.asarray(rgb,dtype=np.float64).reshape(-1,3)-np.asarray(target,dtype=np.float64)
+            return (d*d).sum(1)
+
+        @staticmethod
+        def pairwise_distance(a,b):
+            ''' Distance matrix between an (N,3) and an (M,3) array of colors,
+                same metric as color_distance
+
+            Returns:
+                numpy.ndarray -- (N,M) distances
+            '''
+            import numpy as np
+            a = np.asarray(a,dtype=np.float64).reshape(-1,3)
+            b = np.asarray(b,dtype=np.float64).reshape(-1,3)
+            d = a[:,None,:]-b[None,:,:]
+            return (d*d).sum(2)
@@ -0,0 +1,381 @@
+'''
+ _         _
+(_)_ _  __| |_____ __
+| | ' \/ _` / -_) \ /
+|_|_||_\__,_\___/_\_\
+
+'''
+
+import numpy as np
+
+class palette_index:
+    ''' Reverse color search over many palettes
+
+    Every palette color is stored once in compact arrays: uint8 RGB, the id
+    of its image and its area weight, the fraction of the image's pixels it
+    covers. The colors of one image are contiguous, in insertion order. A
+    bucketed RGB grid (cell x cell x cell buckets, entries sorted by bucket)
+    narrows every query down to the few buckets that can hold a match.
+
+    Inserts are appended and only folded into the grid once enough of them
+    have piled up; until then they are scanned linearly along with the grid
+    candidates. Deletes only mark the entries dead, they are dropped for
+    good when the grid is rebuilt. Distances are Euclidean in 0-255 RGB,
+    i.e. the square root of color.metric.color_distance.
+
+    Usage example:
+    index = palette_index()
+    index.add_many(p.iter_dir("~/catalog",counts=True,jobs=4))
+    index.radius((30,144,255),20,min_weight=0.1)   # images with a dominant
+                                                   # color near #1e90ff
+    index.nearest("#1e90ff",k=10)
+    index.similar("~/catalog/a.jpg",k=10)          # images with similar palettes
+    index.save("catalog.npz")
+    index = palette_index.load("catalog.npz")
+    '''
+
+    def __init__(self,cell=16):
+        if 256%cell:
+            raise Exception("cell must divide 256")
+        self.cell = cell
+        self.grid_size = 256//cell
+        self.n = 0
+        self.colors = np.empty((0,3),dtype=np.uint8)
+        self.ids = np.empty(0,dtype=np.int32)
+        self.weights = np.empty(0,dtype=np.float32)
+        self.alive = np.empty(0,dtype=bool)
+        self.dead = 0
+        # per image: name, first entry, number of entries, alive
+        self.names = []
+        self.name_ids = {}
+        self.img_start = []
+        self.img_count = []
+        self.img_alive = []
+        # the grid: entry numbers sorted by bucket and the offset of every
+        # bucket into them, covering the first n_indexed entries
+        self.order = np.empty(0,dtype=np.int64)
+        self.starts = np.zeros(self.grid_size**3+1,dtype=np.int64)
+        self.n_indexed = 0
+
+    def __len__(self):
+        ''' Number of live images '''
+        return len(self.name_ids)
+
+    def __contains__(self,name):
+        return name in self.name_ids
+
+    def reserve(self,n):
+        if n<=self.colors.shape[0]:
+            return
+        cap = max(n,2*self.colors.shape[0],1024)
+        for attr in ('colors','ids','weights','alive'):
+            old = getattr(self,attr)
+            new = np.zeros((cap,)+old.shape[1:],dtype=old.dtype)
+            new[:self.n] = old[:self.n]
+            setattr(self,attr,new)
+
+    def add(self,name,palette):
+        ''' Insert the palette of an image, replacing an earlier one of the
+            same name
+
+        Arguments:
+            name {str} -- image name, usually its path
+            palette {list} -- ((R,G,B), pixel count) tuples as returned with
+                              counts=True, or bare (R,G,B) tuples which are
+                              then weighted equally
+        '''
+        if name in self.name_ids:
+            self.remove(name)
+        colors, weights = palette_index.as_arrays(palette)
+        k = colors.shape[0]
+        img = len(self.names)
+        self.reserve(self.n+k)
+        self.colors[self.n:self.n+k] = np.clip(np.rint(colors),0,255)
+        self.ids[self.n:self.n+k] = img
+        self.weights[self.n:self.n+k] = weights
+        self.alive[self.n:self.n+k] = True
+        self.names.append(name)
+        self.name_ids[name] = img
+        self.img_start.append(self.n)
+        self.img_count.append(k)
+        self.img_alive.append(True)
+        self.n += k
+
+    @staticmethod
+    def as_arrays(palette):
+        ''' Returns the colors (N,3) and the weights (N,), summing to 1, of a
+            palette given as ((R,G,B), count) or (R,G,B) tuples
+        '''
+        if len(palette) and len(palette[0])==2:
+            colors = np.array([c for c, _ in palette],dtype=np.float64).reshape(-1,3)
+            weights = np.array([w for _, w in palette],dtype=np.float64)
+        else:
+            colors = np.array(palette,dtype=np.float64).reshape(-1,3)
+            weights = np.ones(colors.shape[0])
+        if weights.sum()>0:
+            weights = weights/weights.sum()
+        return colors, weights
+
+    def add_many(self,results):
+        ''' Insert (name, palette) pairs, e.g. the output of
+            palette_generator.generate_parallel or iter_dir. Failed images
+            (exceptions in place of the palette) are skipped
+        '''
+        for name, palette in results:
+            if not isinstance(palette,Exception):
+                self.add(name,palette)
+
+    def remove(self,name):
+        ''' Delete the palette of an image, returns False if it is unknown '''
+        img = self.name_ids.pop(name,None)
+        if img==None:
+            return False
+        s, k = self.img_start[img], self.img_count[img]
+        self.alive[s:s+k] = False
+        self.img_alive[img] = False
+        self.dead += k
+        return True
+
+    def bucket(self,colors):
+        b = colors.astype(np.int64)//self.cell
+        return (b[:,0]*self.grid_size+b[:,1])*self.grid_size+b[:,2]
+
+    def rebuild(self):
+        ''' Fold all pending inserts into the grid and drop deleted entries '''
+        if self.dead:
+            self.compact()
+        keys = self.bucket(self.colors[:self.n])
+        self.order = np.argsort(keys,kind='stable')
+        self.starts = np.searchsorted(keys[self.order],np.arange(self.grid_size**3+1))
+        self.n_indexed = self.n
+
+    def compact(self):
+        keep = self.alive[:self.n]
+        for attr in ('colors','ids','weights','alive'):
+            setattr(self,attr,getattr(self,attr)[:self.n][keep])
+        # image ids are renumbered as well, deleted images are forgotten
+        live = np.flatnonzero(self.img_alive)
+        remap = np.full(len(self.names),-1,dtype=np.int32)
+        remap[live] = np.arange(live.shape[0])
+        self.ids = remap[self.ids]
+        self.names = [self.names[i] for i in live]
+        self.name_ids = {name:i for i, name in enumerate(self.names)}
+        counts = np.bincount(self.ids,minlength=len(self.names))
+        self.img_start = np.concatenate(([0],np.cumsum(counts)[:-1])).astype(np.int64).tolist()
+        self.img_count = counts.tolist()
+        self.img_alive = [True]*len(self.names)
+        self.n = self.ids.shape[0]
+        self.dead = 0
+
+    def refresh(self):
+        # rebuild once the unindexed tail or the dead entries make up a good
+        # share of the index
+        pending = self.n-self.n_indexed
+        if pending>max(4096,self.n_indexed//8) or self.dead>max(4096,self.n//4):
+            self.rebuild()
+
+    def candidates(self,lo,hi):
+        ''' Entry numbers of all entries in the buckets overlapping the RGB
+            box [lo,hi], plus every entry not yet in the grid
+        '''
+        self.refresh()
+        lo = np.clip(np.floor(np.asarray(lo,dtype=np.float64)),0,255).astype(np.int64)//self.cell
+        hi = np.clip(np.floor(np.asarray(hi,dtype=np.float64)),0,255).astype(np.int64)//self.cell
+        g = self.grid_size
+        # buckets sharing r and g are contiguous along b, one slice each
+        rs, gs = np.meshgrid(np.arange(lo[0],hi[0]+1),np.arange(lo[1],hi[1]+1),indexing='ij')
+        first = (rs.ravel()*g+gs.ravel())*g
+        begin = self.starts[first+lo[2]]
+        end = self.starts[first+hi[2]+1]
+        lengths = end-begin
+        total = lengths.sum()
+        # concatenated ranges [begin[i],end[i]) without a Python loop
+        offsets = np.repeat(begin-np.concatenate(([0],np.cumsum(lengths)[:-1])),lengths)
+        idx = self.order[np.arange(total)+offsets]
+        if self.n_indexed<self.n:
+            idx = np.concatenate((idx,np.arange(self.n_indexed,self.n)))
+        return idx
+
+    @staticmethod
+    def parse_color(c):
+        if isinstance(c,str):
+            c = c.lstrip('#')
+            return np.array([int(c[i:i+2],16) for i in (0,2,4)],dtype=np.float64)
+        return np.asarray(c,dtype=np.float64).reshape(3)
+
+    def query(self,target,r,min_weight=0.0):
+        # entry numbers and distances of the live entries within r of target
+        idx = self.candidates(target-r,target+r)
+        d = self.colors[idx].astype(np.float64)-target
+        d = np.sqrt((d*d).sum(1))
+        keep = (d<=r) & self.alive[idx]
+        if min_weight>0:
+            keep &= self.weights[idx]>=min_weight
+        return idx[keep], d[keep]
+
+    def best_per_image(self,idx,d,k=None):
+        order = np.lexsort((idx,d))
+        idx, d = idx[order], d[order]
+        _, first = np.unique(self.ids[idx],return_index=True)
+        first = np.sort(first)[:k]
+        return [(self.names[self.ids[i]],float(dist),tuple(self.colors[i].tolist()),float(self.weights[i]))
+                for i, dist in zip(idx[first],d[first])]
+
+    def radius(self,color,r,min_weight=0.0):
+        ''' Images with a palette color within r of color
+
+        Arguments:
+            color {tuple|str} -- (R,G,B) or "#rrggbb"
+            r {float} -- radius, 0-255 RGB units
+
+        Keyword Arguments:
+            min_weight {float} -- only consider colors covering at least this
+                                  fraction of their image (default: {0.0})
+
+        Returns:
+            list -- (name, distance, (R,G,B), weight) of the closest matching
+                    color of every image, closest first
+        '''
+        idx, d = self.query(palette_index.parse_color(color),r,min_weight)
+        return self.best_per_image(idx,d)
+
+    def nearest(self,color,k=10,min_weight=0.0):
+        ''' The k images whose nearest palette color is closest to color
+
+        The search radius starts at one bucket and doubles until k images are
+        within it, which makes the result exact.
+
+        Returns:
+            list -- (name, distance, (R,G,B), weight), closest first
+        '''
+        target = palette_index.parse_color(color)
+        r = float(self.cell)
+        while True:
+            idx, d = self.query(target,r,min_weight)
+            if np.unique(self.ids[idx]).shape[0]>=k or r>=443.0:
+                return self.best_per_image(idx,d,k)
+            r *= 2
+
+    def palette(self,name):
+        ''' Returns the stored colors (N,3) and weights (N,) of an image '''
+        img = self.name_ids[name]
+        s, k = self.img_start[img], self.img_count[img]
+        return self.colors[s:s+k].astype(np.float64), self.weights[s:s+k].astype(np.float64)
+
+    def similar(self,palette,k=10,r=32.0,exclude_self=True):
+        ''' Images with the most similar palettes
+
+        Palettes are compared by the symmetric, weighted average distance of
+        every color to the nearest color of the other palette, so the
+        dominant colors matter most. Candidates are the images with a color
+        within r of one of the query colors. The radius queries give a lower
+        bound of every candidate's score, and candidates are scored exactly
+        in the order of that bound until it exceeds the k-th best score.
+        Results scoring below r are exact over the whole index.
+
+        Arguments:
+            palette {str|list} -- name of an indexed image, or a palette in
+                                  any form add takes. Unknown names raise
+                                  KeyError
+
+        Keyword Arguments:
+            k {int} -- number of results (default: {10})
+            r {float} -- candidate radius, 0-255 RGB units (default: {32.0})
+            exclude_self {bool} -- leave out the queried image itself
+                                   (default: {True})
+
+        Returns:
+            list -- (name, palette distance) tuples, most similar first
+        '''
+        # rebuild first, it may renumber the images
+        self.refresh()
+        self_id = None
+        if not isinstance(palette,(list,tuple,np.ndarray)) and palette in self.name_ids:
+            if exclude_self:
+                self_id = self.name_ids[palette]
+            colors, weights = self.palette(palette)
+        elif isinstance(palette,str):
+            raise KeyError(palette)
+        else:
+            colors, weights = palette_index.as_arrays(palette)
+        if not colors.shape[0]:
+            return []
+        # both terms of the score with every distance beyond r counted as r
+        # bound the score from below, the radius queries give all the
+        # distances within r
+        first = np.full(len(self.names),r*weights.sum())
+        found, dist = [], []
+        for c, w in zip(colors,weights):
+            idx, d = self.query(c,r)
+            order = np.lexsort((idx,d))
+            img, i = np.unique(self.ids[idx[order]],return_index=True)
+            first[img] -= w*(r-d[order][i])
+            found.append(idx)
+            dist.append(d)
+        idx, d = np.concatenate(found), np.concatenate(dist)
+        order = np.lexsort((idx,d))
+        ent, i = np.unique(idx[order],return_index=True)
+        second = r-np.bincount(self.ids[ent],self.weights[ent]*(r-d[order][i]),minlength=len(self.names))
+        bound = (first+second)/2
+        imgs = np.unique(self.ids[ent])
+        if self_id!=None:
+            imgs = imgs[imgs!=self_id]
+        imgs = imgs[np.argsort(bound[imgs],kind='stable')]
+        names, scores = [], []
+        b, block = 0, max(64,k)
+        while b<imgs.shape[0]:
+            if len(scores)>=k and bound[imgs[b]]>=np.partition(scores,k-1)[k-1]:
+                break
+            chunk = imgs[b:b+block]
+            names.extend(chunk.tolist())
+            starts = np.array([self.img_start[i] for i in chunk])
+            counts = np.array([self.img_count[i] for i in chunk])
+            scores.extend(self.palette_distance(colors,weights,starts,counts).tolist())
+            b += block
+            block *= 2
+        best = np.argsort(scores,kind='stable')[:k]
+        return [(self.names[names[i]],float(scores[i])) for i in best]
+
+    def palette_distance(self,colors,weights,starts,counts):
+        ''' Distances of the palette (colors, weights) to the stored palettes
+            with the given first entries and entry counts, see similar
+        '''
+        seg = np.concatenate(([0],np.cumsum(counts)[:-1]))
+        ent = np.repeat(starts-seg,counts)+np.arange(counts.sum())
+        owner = np.repeat(np.arange(counts.shape[0]),counts)
+        d = colors[:,None,:]-self.colors[ent].astype(np.float64)[None,:,:]
+        d = np.sqrt((d*d).sum(2))
+        # query colors to their nearest color in each palette and back
+        score = weights.dot(np.minimum.reduceat(d,seg,axis=1))
+        score += np.bincount(owner,self.weights[ent]*d.min(0),minlength=counts.shape[0])
+        return score/2
+
+    def save(self,path):
+        ''' Write the index to an .npz file '''
+        self.refresh()
+        np.savez(path,cell=self.cell,colors=self.colors[:self.n],ids=self.ids[:self.n],
+                 weights=self.weights[:self.n],alive=self.alive[:self.n],
+                 names=np.array(self.names,dtype=np.str_),img_start=np.array(self.img_start,dtype=np.int64),
+                 img_count=np.array(self.img_count,dtype=np.int64),img_alive=np.array(self.img_alive,dtype=bool),
+                 order=self.order,starts=self.starts,n_indexed=self.n_indexed)
+
+    @staticmethod
+    def load(path):
+        ''' Read an index written by save '''
+        with np.load(path) as f:
+            index = palette_index(int(f['cell']))
+            index.colors = f['colors']
+            index.ids = f['ids']
+            index.weights = f['weights']
+            index.alive = f['alive']
+            index.n = index.colors.shape[0]
+            index.dead = int((~index.alive).sum())
+            index.names = f['names'].tolist()
+            index.img_start = f['img_start'].tolist()
+            index.img_count = f['img_count'].tolist()
+            index.img_alive = f['img_alive'].tolist()
+            index.name_ids = {name:i for i, (name, a) in enumerate(zip(index.names,index.img_alive)) if a}
+            index.order = f['order']
+            index.starts = f['starts']
+            index.n_indexed = int(f['n_indexed'])
+        return index
@@ -0,0 +1,380 @@
+'''
+                    _
+ ___ ___ _ ___ _(_)__ ___
+(_-</ -_) '_\ V / / _/ -_)
+/__/\___|_|  \_/|_\__\___|
+
+'''
+
+import asyncio
+import argparse
+import concurrent.futures
+import json
+import sys
+import urllib.parse
+import numpy as np
+from .__main__ import palette_generator
+from .__main__ import SORT_ORDERS
+from .__main__ import parse_color
+from .color_wheel import color
+
+class service_busy(Exception):
+    ''' Raised when a palette_service already holds max_pending requests '''
+
+class palette_service:
+    ''' Asyncio front end of palette_generator
+
+    Requests carry the encoded image as bytes. Concurrent requests that share
+    output_colors and subsampling_size are collected into micro-batches,
+    decoded and clustered together with split_stacked on a bounded executor,
+    so the event loop never blocks and the per-image overhead is shared. A
+    batch is sent off once max_batch requests are waiting or batch_window
+    seconds after its first request, and only while an executor slot is
+    free, so batches grow by themselves when the workers are saturated.
+
+    At most max_pending requests are admitted at once, further ones fail
+    right away with service_busy instead of queueing without bound, and
+    every request gives up after timeout seconds with asyncio.TimeoutError.
+    A request cannot stop clustering that already runs, so output_colors and
+    subsampling_size are capped at max_colors and max_size (ValueError
+    beyond). Every parameter set has its own batcher, which is dropped after
+    idle_timeout seconds without requests; at most max_keys of them live at
+    once, a request for yet another one fails with service_busy.
+
+    Usage example:
+    async with palette_service(max_workers=4) as service:
+        palette = await service.generate(data,top=8)
+        server = await service.serve("127.0.0.1",8080)
+        await server.serve_forever()
+
+    From the shell:
+    python -m palettely.service --port 8080 --workers 4
+    curl --data-binary @image.jpg "localhost:8080/palette?colors=20&top=8"
+    '''
+
+    def __init__(self,output_colors=20,subsampling_size=24,fast_load=False,max_workers=None,executor=None,
+                 max_batch=32,batch_window=0.002,max_pending=1024,timeout=10.0,max_body=64<<20,
+                 max_colors=256,max_size=128,max_keys=16,idle_timeout=60.0):
+        self.output_colors = output_colors
+        self.subsampling_size = subsampling_size
+        self.fast_load = fast_load
+        # decoding (PIL) and clustering (numpy) release the GIL for most of
+        # their time, so threads are the default. A ProcessPoolExecutor can be
+        # passed in instead
+        self.executor = executor or concurrent.futures.ThreadPoolExecutor(max_workers)
+        self.own_executor = executor==None
+        self.workers = max_workers or getattr(self.executor,'_max_workers',None) or 1
+        self.max_batch = max_batch
+        self.batch_window = batch_window
+        self.max_pending = max_pending
+        self.timeout = timeout
+        self.max_body = max_body
+        self.max_colors = max_colors
+        self.max_size = max_size
+        self.max_keys = max_keys
+        self.idle_timeout = idle_timeout
+        self.pending = 0
+        self.counters = dict.fromkeys(("requests","rejected","timeouts","errors","batches","batched"),0)
+        self._generators = {}
+        self._queues = {}
+        self._batchers = {}
+        self._slots = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self,*exc):
+        await self.close()
+
+    async def close(self):
+        for task in self._batchers.values():
+            task.cancel()
+        await asyncio.gather(*self._batchers.values(),return_exceptions=True)
+        self._batchers.clear()
+        self._queues.clear()
+        if self.own_executor:
+            self.executor.shutdown(wait=False,cancel_futures=True)
+
+    def params(self,output_colors=None,subsampling_size=None):
+        ''' Returns the (output_colors, subsampling_size) key of a request,
+            ValueError if either is out of range
+        '''
+        key = (self.output_colors if output_colors is None else output_colors,
+               self.subsampling_size if subsampling_size is None else subsampling_size)
+        if not 1<=key[0]<=self.max_colors:
+            raise ValueError("colors must be between 1 and {}".format(self.max_colors))
+        if not 1<=key[1]<=self.max_size:
+            raise ValueError("size must be between 1 and {}".format(self.max_size))
+        return key
+
+    def generator(self,key):
+        if key not in self._generators:
+            output_colors, subsampling_size = key
+            self._generators[key] = palette_generator(output_colors,subsampling_size,fast_load=self.fast_load)
+        return self._generators[key]
+
+    async def generate(self, data, sortby="area", option=None, top=None, min_coverage=0.0, counts=False,
+                       output_colors=None, subsampling_size=None, timeout=None):
+        ''' Generate the palette of an encoded image
+
+        Arguments:
+            data {bytes} -- contents of an image file
+
+        Keyword Arguments:
+            sortby, option, top, min_coverage, counts -- as in
+                palette_generator.generate
+            output_colors {int} -- overrides the service default
+                                   (default: {None})
+            subsampling_size {int} -- overrides the service default
+                                      (default: {None})
+            timeout {float} -- overrides the service default (default: {None})
+
+        Returns:
+            list -- (R,G,B) tuples, or ((R,G,B), count) tuples with counts
+
+        Raises:
+            ValueError -- output_colors or subsampling_size beyond the caps
+            service_busy -- too many pending requests or parameter sets
+        '''
+        key = self.params(output_colors,subsampling_size)
+        if self.pending>=self.max_pending:
+            self.counters['rejected'] += 1
+            raise service_busy("{} requests pending".format(self.pending))
+        if key not in self._batchers and len(self._batchers)>=self.max_keys:
+            self.counters['rejected'] += 1
+            raise service_busy("{} parameter sets in use".format(len(self._batchers)))
+        loop = asyncio.get_running_loop()
+        if self._slots==None:
+            self._slots = asyncio.Semaphore(self.workers)
+        if key not in self._batchers:
+            self._queues[key] = asyncio.Queue()
+            self._batchers[key] = loop.create_task(self.batcher(key))
+        self.pending += 1
+        self.counters['requests'] += 1
+        future = loop.create_future()
+        try:
+            self._queues[key].put_nowait((data,future))
+            leaves = await asyncio.wait_for(future,self.timeout if timeout==None else timeout)
+        except asyncio.TimeoutError:
+            self.counters['timeouts'] += 1
+            raise
+        except Exception:
+            self.counters['errors'] += 1
+            raise
+        finally:
+            self.pending -= 1
+        tmp = palette_generator.get_palette(leaves,sortby,option,min_coverage,counts)
+        if top!=None and top<=len(tmp) and top>=0:
+            tmp = tmp[0:top]
+        return tmp
+
+    async def batcher(self,key):
+        ''' Forms the micro-batches of one parameter set, and goes away with
+            its queue and generator after idle_timeout seconds without one
+        '''
+        loop = asyncio.get_running_loop()
+        queue = self._queues[key]
+        generator = self.generator(key)
+        while True:
+            try:
+                batch = [await asyncio.wait_for(queue.get(),self.idle_timeout)]
+            except asyncio.TimeoutError:
+                # nothing can be queued between this check and the removal
+                if queue.empty():
+                    del self._batchers[key], self._queues[key], self._generators[key]
+                    return
+                continue
+            deadline = loop.time()+self.batch_window
+            while len(batch)<self.max_batch:
+                try:
+                    batch.append(await asyncio.wait_for(queue.get(),deadline-loop.time()))
+                except asyncio.TimeoutError:
+                    break
+            await self._slots.acquire()
+            # whatever arrived while waiting for a worker joins this batch
+            while len(batch)<self.max_batch and not queue.empty():
+                batch.append(queue.get_nowait())
+            # requests that timed out in the meantime are not worked on
+            batch = [b for b in batch if not b[1].done()]
+            if not batch:
+                self._slots.release()
+                continue
+            loop.create_task(self.run_batch(generator,batch))
+
+    async def run_batch(self,generator,batch):
+        loop = asyncio.get_running_loop()
+        self.counters['batches'] += 1
+        self.counters['batched'] += len(batch)
+        try:
+            results = await loop.run_in_executor(self.executor,cluster_batch,generator,[b[0] for b in batch])
+        except Exception as e:
+            results = [e]*len(batch)
+        finally:
+            self._slots.release()
+        for (_,future), r in zip(batch,results):
+            if future.done():
+                continue
+            if isinstance(r,Exception):
+                future.set_exception(r)
+            else:
+                future.set_result(r)
+
+    def stats(self):
+        ''' Returns the request counters and the mean batch size '''
+        ret = dict(self.counters,pending=self.pending)
+        ret['mean_batch'] = self.counters['batched']/self.counters['batches'] if self.counters['batches'] else 0.0
+        return ret
+
+    async def serve(self,host="127.0.0.1",port=8080):
+        ''' Start a minimal HTTP/1.1 server on top of the service
+
+        POST /palette with the image as body, parameters in the query string
+        (colors, size, sortby, option, top, min_coverage, counts, timeout),
+        answers {"palette": [hex codes]} and with counts also "counts".
+        GET /stats returns the counters. Parameters out of range answer 400,
+        overload 503, timeouts 504 and images that cannot be decoded 422.
+
+        Returns:
+            asyncio.Server -- the listening server
+        '''
+        return await asyncio.start_server(self.handle,host,port)
+
+    async def handle(self,reader,writer):
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                method, target, version = line.decode('latin-1').split()
+                headers = {}
+                while True:
+                    h = await reader.readline()
+                    if h in (b'\r\n',b'\n',b''):
+                        break
+                    k, _, v = h.decode('latin-1').partition(':')
+                    headers[k.strip().lower()] = v.strip()
+                length = int(headers.get('content-length',0))
+                if length>self.max_body:
+                    await self.respond(writer,413,{"error":"body larger than {} bytes".format(self.max_body)},False)
+                    break
+                body = await reader.readexactly(length)
+                status, payload = await self.dispatch(method,target,body)
+                keep_alive = version=='HTTP/1.1' and headers.get('connection','').lower()!='close'
+                await self.respond(writer,status,payload,keep_alive)
+                if not keep_alive:
+                    break
+        except (asyncio.IncompleteReadError,ConnectionError,ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def dispatch(self,method,target,body):
+        url = urllib.parse.urlsplit(target)
+        if url.path=='/stats' and method=='GET':
+            return 200, self.stats()
+        if url.path!='/palette':
+            return 404, {"error":"not found"}
+        if method!='POST':
+            return 405, {"error":"POST the image to /palette"}
+        try:
+            q = dict(urllib.parse.parse_qsl(url.query))
+            sortby = q.get('sortby','area')
+            if sortby not in SORT_ORDERS:
+                raise ValueError("unknown sortby {!r}".format(sortby))
+            option = parse_color(q['option']) if 'option' in q else None
+            counts = q.get('counts','0').lower() in ('1','true','yes')
+            kwargs = dict(sortby=sortby,option=option,counts=counts,
+                          top=int(q['top']) if 'top' in q else None,
+                          min_coverage=float(q.get('min_coverage',0.0)),
+                          output_colors=int(q['colors']) if 'colors' in q else None,
+                          subsampling_size=int(q['size']) if 'size' in q else None,
+                          timeout=float(q['timeout']) if 'timeout' in q else None)
+            self.params(kwargs['output_colors'],kwargs['subsampling_size'])
+        except (ValueError,argparse.ArgumentTypeError) as e:
+            return 400, {"error":str(e)}
+        try:
+            palette = await self.generate(body,**kwargs)
+        except service_busy as e:
+            return 503, {"error":str(e)}
+        except asyncio.TimeoutError:
+            return 504, {"error":"timed out"}
+        except Exception as e:
+            return 422, {"error":str(e) or type(e).__name__}
+        if counts:
+            return 200, {"palette":[color.to_hex(*c) for c, _ in palette], "counts":[n for _, n in palette]}
+        return 200, {"palette":[color.to_hex(*c) for c in palette]}
+
+    @staticmethod
+    async def respond(writer,status,payload,keep_alive=True):
+        reasons = {200:"OK",400:"Bad Request",404:"Not Found",405:"Method Not Allowed",413:"Payload Too Large",
+                   422:"Unprocessable Entity",503:"Service Unavailable",504:"Gateway Timeout"}
+        body = json.dumps(payload).encode()
+        head = "HTTP/1.1 {} {}\r\nContent-Type: application/json\r\nContent-Length: {}\r\n".format(status,reasons[status],len(body))
+        if status==503:
+            head += "Retry-After: 1\r\n"
+        if not keep_alive:
+            head += "Connection: close\r\n"
+        writer.write(head.encode('latin-1')+b"\r\n"+body)
+        await writer.drain()
+
+
+def cluster_batch(generator, images):
+    ''' Decode and cluster a batch of images in one split_stacked run
+
+    Images that fail to decode get their exception in place of the leaves,
+    the rest of the batch is unaffected. Module level so that it can be
+    pickled for a ProcessPoolExecutor.
+    '''
+    ret = [None]*len(images)
+    pixels = []
+    ok = []
+    for i, im in enumerate(images):
+        try:
+            pixels.append(generator.load_image(im).reshape(-1,3))
+            ok.append(i)
+        except Exception as e:
+            ret[i] = e
+    if pixels:
+        means, pop, leaves = palette_generator.split_stacked(np.stack(pixels).astype(np.float64),generator.no_of_colors-1)
+        for j, i in enumerate(ok):
+            ret[i] = [(k+1,means[j,k],pop[j,k]) for k in range(leaves[j])]
+    return ret
+
+async def run_server(args):
+    executor = concurrent.futures.ProcessPoolExecutor(args.workers) if args.processes else None
+    async with palette_service(args.output_colors,args.subsampling_size,args.fast_load,args.workers,executor,
+                               args.max_batch,args.batch_window,args.max_pending,args.timeout,
+                               max_colors=args.max_colors,max_size=args.max_size,max_keys=args.max_keys) as service:
+        server = await service.serve(args.host,args.port)
+        host, port = server.sockets[0].getsockname()[:2]
+        print("listening on http://{}:{}".format(host,port),flush=True)
+        async with server:
+            await server.serve_forever()
+    if executor!=None:
+        executor.shutdown()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m palettely.service",description="HTTP palette service")
+    parser.add_argument("--host",default="127.0.0.1")
+    parser.add_argument("--port",type=int,default=8080,help="0 picks a free port (default: 8080)")
+    parser.add_argument("-n","--output-colors",type=int,default=20,help="default number of clusters (default: 20)")
+    parser.add_argument("-s","--subsampling-size",type=int,default=24,help="default subsampling size (default: 24)")
+    parser.add_argument("--fast-load",action="store_true",help="decode close to the subsampling size")
+    parser.add_argument("-w","--workers",type=int,default=None,help="executor workers (default: executor's own)")
+    parser.add_argument("--processes",action="store_true",help="use worker processes instead of threads")
+    parser.add_argument("--max-batch",type=int,default=32,help="largest micro-batch (default: 32)")
+    parser.add_argument("--batch-window",type=float,default=0.002,help="seconds a batch waits to fill (default: 0.002)")
+    parser.add_argument("--max-pending",type=int,default=1024,help="requests admitted before answering 503 (default: 1024)")
+    parser.add_argument("--timeout",type=float,default=10.0,help="per-request timeout in seconds (default: 10)")
+    parser.add_argument("--max-colors",type=int,default=256,help="largest colors a request may ask for (default: 256)")
+    parser.add_argument("--max-size",type=int,default=128,help="largest size a request may ask for (default: 128)")
+    parser.add_argument("--max-keys",type=int,default=16,help="distinct colors/size pairs served at once (default: 16)")
+    args = parser.parse_args(argv)
+    try:
+        asyncio.run(run_server(args))
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+if __name__=="__main__":
+    sys.exit(main())
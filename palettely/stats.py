@@ -0,0 +1,177 @@
+'''
+     _        _
+ ___| |_ __ _| |_ ___
+(_-<|  _/ _` |  _(_-<
+/__/ \__\__,_|\__/__/
+
+'''
+
+import contextlib
+import sys
+import time
+import tracemalloc
+try:
+    import resource
+except ImportError:
+    resource = None
+
+def _status(field):
+    # a field of /proc/self/status in bytes, None where there is no /proc
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith(field+':'):
+                    return int(line.split()[1])*1024
+    except OSError:
+        pass
+    return None
+
+def _reset_peak_rss():
+    # writing 5 to clear_refs resets VmHWM to the current RSS (Linux 4.0+)
+    try:
+        with open('/proc/self/clear_refs','w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+def _peak_rss():
+    peak = _status('VmHWM')
+    if peak==None and resource!=None:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # kilobytes on Linux, bytes on macOS
+        peak *= 1 if sys.platform=='darwin' else 1024
+    return peak
+
+class palette_stats:
+    ''' Per-stage timings of palette generation
+
+    Pass an instance as the stats argument of palette_generator.generate (or
+    generate_from_dir, generate_parallel, ...) and it accumulates, over every
+    image it is handed:
+
+        stages -- {stage: [seconds, calls]} for decode, resize, cache,
+                  cluster and get_palette
+        splits -- number of split iterations, the time spent in them and
+                  the number of pixels they projected
+        images -- one record per image with its total time, so slow images
+                  can be found
+        peak_bytes -- the largest peak of traced allocations of a single
+                      image, only with trace_memory=True. tracemalloc sees
+                      Python and numpy allocations but not PIL's, so decoding
+                      is not part of it
+        peak_rss -- the largest growth of the process RSS high-water mark
+                    during a single image, decoding included, only with
+                    trace_memory=True. On Linux the high-water mark is reset
+                    for every image; elsewhere it is the lifetime maximum
+                    (ru_maxrss), so an image that stays below an earlier peak
+                    reports 0
+
+    callback, if given, is called with the record of every image as soon as
+    it is done, e.g. to push it to a metrics pipeline. When no stats object
+    is passed none of this is measured.
+
+    Usage example:
+    stats = palette_stats()
+    p.generate_from_dir("~",stats=stats)
+    print(stats.as_dict())
+    '''
+
+    def __init__(self,trace_memory=False,callback=None):
+        self.trace_memory = trace_memory
+        self.callback = callback
+        self.stages = {}
+        self.split_count = 0
+        self.split_time = 0.0
+        self.split_pixels = 0
+        self.images = []
+        self.peak_bytes = 0
+        self.peak_rss = 0
+        self._image = None
+
+    # the callback usually is not picklable and stays in the parent process
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['callback'] = None
+        return state
+
+    def record(self,stage,seconds,calls=1):
+        entry = self.stages.setdefault(stage,[0.0,0])
+        entry[0] += seconds
+        entry[1] += calls
+
+    @contextlib.contextmanager
+    def timer(self,stage):
+        t = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(stage,time.perf_counter()-t)
+
+    def record_split(self,seconds,pixels):
+        self.split_count += 1
+        self.split_time += seconds
+        self.split_pixels += int(pixels)
+        if self._image!=None:
+            self._image['splits'] += 1
+            self._image['split_pixels'] += int(pixels)
+
+    @contextlib.contextmanager
+    def image(self,name):
+        ''' Context of the generation of one image '''
+        self._image = {'image':name, 'time':0.0, 'splits':0, 'split_pixels':0}
+        tracing = self.trace_memory and not tracemalloc.is_tracing()
+        if tracing:
+            tracemalloc.start()
+        if self.trace_memory:
+            _reset_peak_rss()
+            rss = _peak_rss()
+        t = time.perf_counter()
+        try:
+            yield
+        finally:
+            self._image['time'] = time.perf_counter()-t
+            if self.trace_memory and tracemalloc.is_tracing():
+                self._image['peak_bytes'] = tracemalloc.get_traced_memory()[1]
+                self.peak_bytes = max(self.peak_bytes,self._image['peak_bytes'])
+                if tracing:
+                    tracemalloc.stop()
+            if self.trace_memory and rss!=None:
+                self._image['peak_rss'] = max(0,_peak_rss()-rss)
+                self.peak_rss = max(self.peak_rss,self._image['peak_rss'])
+            self.add_image(self._image)
+            self._image = None
+
+    def add_image(self,record):
+        self.images.append(record)
+        if self.callback!=None:
+            self.callback(record)
+
+    def merge(self,other):
+        ''' Add the numbers of another palette_stats, e.g. one returned by a
+            worker process, to this one
+        '''
+        for stage, (seconds, calls) in other.stages.items():
+            self.record(stage,seconds,calls)
+        self.split_count += other.split_count
+        self.split_time += other.split_time
+        self.split_pixels += other.split_pixels
+        self.peak_bytes = max(self.peak_bytes,other.peak_bytes)
+        self.peak_rss = max(self.peak_rss,other.peak_rss)
+        for record in other.images:
+            self.add_image(record)
+        return self
+
+    def slowest(self,n=10):
+        return sorted(self.images,key=lambda r:r['time'],reverse=True)[:n]
+
+    def as_dict(self):
+        ''' Returns all numbers as plain, JSON serializable types '''
+        return {
+            'images':len(self.images),
+            'total_time':sum(r['time'] for r in self.images),
+            'stages':{k:{'time':v[0],'calls':v[1]} for k, v in self.stages.items()},
+            'splits':{'count':self.split_count,'time':self.split_time,'pixels':self.split_pixels},
+            'peak_bytes':self.peak_bytes,
+            'peak_rss':self.peak_rss,
+        }
@@ -9,11 +9,20 @@
 '''
 
 import os
+import sys
+import shutil
+from .color_wheel import color
+
+# xterm 256 color palette: 6x6x6 color cube from index 16, gray ramp from 232
+_CUBE_LEVELS = (0,95,135,175,215,255)
+# nearest cube level and nearest gray ramp step of every 0-255 value
+_CUBE_INDEX = [min(range(6),key=lambda i:abs(_CUBE_LEVELS[i]-v)) for v in range(256)]
+_GRAY_INDEX = [min(23,max(0,(v-3)//10)) for v in range(256)]
 
 class termcolor:
    __PURPLE = '\033[95m'
    __CYAN = '\033[96m'
-   __DARK__CYAN = '\033[36m'
+   __DARKCYAN = '\033[36m'
    __BLUE = '\033[94m'
    __GREEN = '\033[92m'
    __YELLOW = '\033[93m'
@@ -21,56 +30,134 @@ class termcolor:
    __BOLD = '\033[1m'
    __UNDERLINE = '\033[4m'
    __END = '\033[0m'
-   __truecolor = False
-   if os.environ['COLORTERM']=='truecolor':
-      __truecolor = True
+   __truecolor = os.environ.get('COLORTERM','') in ('truecolor','24bit')
 
    @staticmethod
    def purple(text):
-      return termcolor.__PURPLE+text+termcolor.END
+      return termcolor.__PURPLE+text+termcolor.__END
 
    @staticmethod
    def cyan(text):
-      return termcolor.__CYAN+text+termcolor.END
+      return termcolor.__CYAN+text+termcolor.__END
 
    @staticmethod
    def darkcyan(text):
-      return termcolor.__DARKCYAN+text+termcolor.END
+      return termcolor.__DARKCYAN+text+termcolor.__END
 
    @staticmethod
    def blue(text):
-      return termcolor.__BLUE+text+termcolor.END
+      return termcolor.__BLUE+text+termcolor.__END
 
    @staticmethod
    def green(text):
-      return termcolor.__GREEN+text+termcolor.END
+      return termcolor.__GREEN+text+termcolor.__END
 
    @staticmethod
    def yellow(text):
-      return termcolor.__YELLOW+text+termcolor.END
+      return termcolor.__YELLOW+text+termcolor.__END
 
    @staticmethod
    def red(text):
-      return termcolor.__RED+text+termcolor.END
+      return termcolor.__RED+text+termcolor.__END
 
    @staticmethod
    def bold(text):
-      return termcolor.__BOLD+text+termcolor.END
+      return termcolor.__BOLD+text+termcolor.__END
 
    @staticmethod
    def underline(text):
-      return termcolor.__UNDERLINE+text+termcolor.END
+      return termcolor.__UNDERLINE+text+termcolor.__END
+
+   @staticmethod
+   def truecolor():
+      return termcolor.__truecolor
 
    @staticmethod
-   def rgb(text, c=(255,0,0)):
-      if termcolor.__truecolor:
+   def rgb_to_256(c):
+      ''' Returns the index of the xterm 256 color palette entry nearest to c,
+          out of the color cube and the gray ramp
+      '''
+      r, g, b = _CUBE_INDEX[c[0]], _CUBE_INDEX[c[1]], _CUBE_INDEX[c[2]]
+      cube = (_CUBE_LEVELS[r],_CUBE_LEVELS[g],_CUBE_LEVELS[b])
+      k = _GRAY_INDEX[(c[0]+c[1]+c[2])//3]
+      gray = 8+10*k
+      def dist(x):
+         return (x[0]-c[0])**2+(x[1]-c[1])**2+(x[2]-c[2])**2
+      if dist((gray,gray,gray))<dist(cube):
+         return 232+k
+      return 16+36*r+6*g+b
+
+   @staticmethod
+   def rgb(text, c=(255,0,0), truecolor=None):
+      ''' Colors text with c. Without truecolor argument, text is returned
+          as is unless the terminal supports true color; truecolor=False
+          picks the nearest xterm 256 color instead
+      '''
+      if truecolor==None:
+         if not termcolor.__truecolor:
+            return text
+         truecolor = True
+      if truecolor:
          return u"\033[38;2;{};{};{}m{}\x1b[0m".format(c[0],c[1],c[2],text)
-      return text
+      return u"\033[38;5;{}m{}\x1b[0m".format(termcolor.rgb_to_256(c),text)
 
    @staticmethod
-   def rgb_box(c=(255,0,0),n=1):
-      return termcolor.rgb(u"\u2588"*n,c)
+   def rgb_box(c=(255,0,0),n=1,truecolor=None):
+      return termcolor.rgb(u"\u2588"*n,c,truecolor)
 
    @staticmethod
    def get_term_size():
-      return os.popen('stty size', 'r').read().split()
\ No newline at end of file
+      ''' Returns (rows, columns) of the terminal, (24, 80) if not a tty '''
+      size = shutil.get_terminal_size((80,24))
+      return (size.lines, size.columns)
+
+
+class palette_renderer:
+   ''' Buffered palette renderer
+
+   Reads the terminal size and color support once and writes every palette
+   as a single string, instead of one print per swatch. When file is not a
+   terminal (or color=False) no escape sequences are written, palettes are
+   listed as hex codes instead.
+
+   Usage example:
+   r = palette_renderer()
+   for palette, name in p.generate_from_dir("~"):
+      r.write(palette,name)
+   '''
+
+   def __init__(self, file=None, width=None, truecolor=None, color=None):
+      self.file = file if file!=None else sys.stdout
+      if color==None:
+         isatty = getattr(self.file,'isatty',None)
+         color = bool(isatty and isatty())
+      self.color = color
+      self.width = width if width!=None else termcolor.get_term_size()[1]
+      self.truecolor = truecolor if truecolor!=None else termcolor.truecolor()
+      # escape sequences of colors already seen
+      self.__boxes = {}
+
+   def render(self, palette, label=None):
+      ''' Returns the palette as one row of boxes filling the terminal
+          width, preceded by label if given
+      '''
+      if not palette:
+         return (label+"\n" if label!=None else "")+"\n"
+      parts = [label+"\n"] if label!=None else []
+      if not self.color:
+         parts.append(" ".join(color.to_hex(*c) for c in palette))
+         parts.append("\n")
+         return "".join(parts)
+      n = max(self.width//len(palette),1)
+      for c in palette:
+         c = tuple(c)
+         box = self.__boxes.get((c,n))
+         if box==None:
+            box = self.__boxes[(c,n)] = termcolor.rgb_box(c,n,self.truecolor)
+         parts.append(box)
+      parts.append("\n")
+      return "".join(parts)
+
+   def write(self, palette, label=None):
+      self.file.write(self.render(palette,label))
+      self.file.flush()
\ No newline at end of file